@@ -4,8 +4,7 @@ import sys, pathlib
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 
 from m1n1.setup import *
-
-blacklist = []
+from m1n1.find_mmio import find_mmio
 
 print("Dumping address space...")
 of = None
@@ -13,13 +12,8 @@ if len(sys.argv) > 1:
 	of = open(sys.argv[1],"w")
 	print("Also dumping to file %s")
 
-for i in range(0x0000, 0x10000):
-	if i in blacklist:
-		v = "%08x: SKIPPED"%(i<<16)
-	else:
-		a = (i<<16) + 0x1000
-		d = p.read32(a)
-		v = "%08x: %08x"%(a, d)
+for a, d in find_mmio(u, 0x1000, 0x100000000, 0x10000):
+	v = "%08x: %08x"%(a, d)
 	print(v)
 	if of:
 		of.write(v+"\n")
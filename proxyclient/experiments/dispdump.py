@@ -4,8 +4,7 @@ import sys, pathlib
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 
 from m1n1.setup import *
-
-blacklist = []
+from m1n1.find_mmio import find_mmio
 
 print("Dumping address space...")
 of = None
@@ -15,13 +14,8 @@ if len(sys.argv) > 1:
 
 p.iodev_set_usage(IODEV.FB, 0)
 
-for i in range(0x230000000, 0x232000000, 0x4000):
-    if i in blacklist:
-        v = "%08x: SKIPPED"%(i<<16)
-    else:
-        a = i
-        d = p.read32(a)
-        v = "%08x: %08x"%(a, d)
+for a, d in find_mmio(u, 0x230000000, 0x232000000, 0x4000):
+    v = "%08x: %08x"%(a, d)
     print(v)
     if of:
         of.write(v+"\n")
@@ -3,20 +3,56 @@
 import sys, pathlib
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 
+import argparse, time
+
 from m1n1.setup import *
+from m1n1.memimage import MemImage
+
+def parse_range(s):
+    start, size = s.split(":")
+    return int(start, 0), int(size, 0)
+
+parser = argparse.ArgumentParser(description='Capture physical memory into a sparse, resumable image')
+parser.add_argument('image', type=pathlib.Path)
+parser.add_argument('-r', '--region', action="append", default=[],
+                    help="/chosen/memory-map region to capture (default: all of DRAM)")
+parser.add_argument('-R', '--range', action="append", default=[], type=parse_range,
+                    help="address range to capture, as start:size")
+parser.add_argument('-l', '--list', action="store_true", help="list memory-map regions and exit")
+parser.add_argument('-b', '--block', type=lambda x: int(x, 0), default=0x4000)
+parser.add_argument('-d', '--depth', type=int, default=None,
+                    help="reads kept in flight (default: 1, or 2 on USB links; "
+                         "only raise it if the link buffers queued commands)")
+parser.add_argument('-j', '--workers', type=int, default=None)
+args = parser.parse_args()
+
+chosen = u.adt["chosen"]
+# (addr, size) properties decode as lists
+memory_map = {k: tuple(v) for k, v in chosen["memory-map"]._properties.items()
+              if isinstance(v, (list, tuple)) and len(v) == 2}
 
-p = 0x800000000
-limit = u.base
-block = 0x40000
+if args.list:
+    print(f"dram: 0x{chosen.dram_base:x} .. 0x{chosen.dram_base + chosen.dram_size:x}")
+    for name, (addr, size) in sorted(memory_map.items(), key=lambda i: i[1]):
+        print(f"{name}: 0x{addr:x} .. 0x{addr + size:x}")
+    sys.exit(0)
 
-while p < limit:
-    f = "mem/0x%x.bin" % p
-    if os.path.exists(f):
-        p += block
-        continue
+ranges = list(args.range)
+for name in args.region:
+    if name not in memory_map:
+        raise Exception(f"Unknown memory-map region {name!r} (see --list)")
+    ranges.append(memory_map[name])
+if not ranges:
+    ranges.append((chosen.dram_base, chosen.dram_size))
 
-    print("dumping 0x%x..." % p)
+start = time.time()
+def progress(done, total):
+    rate = done / max(time.time() - start, 1e-3)
+    sys.stdout.write(f"\r0x{done:x} / 0x{total:x} bytes ({100 * done / max(total, 1):.1f}%, {rate / 1e6:.1f} MB/s)")
+    sys.stdout.flush()
 
-    data = iface.readmem(p, block)
-    open(f, "wb").write(data)
-    p += block
+with MemImage(str(args.image), args.block) as img:
+    img.capture(u, ranges, depth=args.depth, workers=args.workers, progress=progress)
+    print()
+    for addr, size in img.covered():
+        print(f"Captured 0x{addr:x} .. 0x{addr + size:x}")
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+# Stress test of the link locking: several threads share one UartInterface
+# and M1N1Proxy, talking to a local stand-in target that implements the
+# proxy protocol on a byte stream (a few proxy ops and memory transfers, on
+# a block of fake RAM). Each thread checks its own memory round trips, and
+# all of them increment a shared counter with read-modify-write sections;
+# any interleaving on the link shows up as corrupt replies, wrong data or a
+# lost update. Does not need a target.
+#
+# With --unlocked, the link lock is replaced by a no-op, to check that the
+# test does catch interleaving.
+
+import argparse, random, struct, threading, time
+
+from m1n1.proxy import UartInterface, M1N1Proxy, PRIO
+
+class StandInTarget:
+    '''Serial-like device running a minimal m1n1 proxy on fake RAM'''
+    BASE = 0x800000000
+
+    def __init__(self, size=0x100000):
+        self.mem = bytearray(size)
+        self.timeout = 3
+        self.baudrate = 115200
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.cond = threading.Condition()
+        self.exc_count = 0
+        self.data_csums = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    # Host side
+    def write(self, data):
+        with self.cond:
+            self.inbuf += data
+            self.cond.notify_all()
+
+    def read(self, size):
+        with self.cond:
+            self.cond.wait_for(lambda: self.outbuf, self.timeout)
+            data = bytes(self.outbuf[:size])
+            del self.outbuf[:size]
+            return data
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    # Target side
+    def _read(self, size):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.inbuf) >= size)
+            data = bytes(self.inbuf[:size])
+            del self.inbuf[:size]
+            return data
+
+    def _send(self, data):
+        with self.cond:
+            self.outbuf += data
+            self.cond.notify_all()
+
+    def _reply(self, rtype, status, payload=b""):
+        reply = struct.pack("<Ii24s", rtype, status, payload)
+        self._send(reply + struct.pack("<I", UartInterface.checksum(None, reply)))
+
+    def _range(self, addr, size):
+        off = addr - self.BASE
+        if off < 0 or off + size > len(self.mem):
+            return None
+        return slice(off, off + size)
+
+    def _proxy(self, op, args):
+        rw = {M1N1Proxy.P_READ64: 8, M1N1Proxy.P_READ32: 4,
+              M1N1Proxy.P_WRITE64: 8, M1N1Proxy.P_WRITE32: 4}
+        if op == M1N1Proxy.P_NOP:
+            return 0
+        elif op == M1N1Proxy.P_GET_BASE:
+            return self.BASE
+        elif op == M1N1Proxy.P_SET_EXC_GUARD:
+            self.exc_count = 0
+            return 0
+        elif op == M1N1Proxy.P_GET_EXC_COUNT:
+            count, self.exc_count = self.exc_count, 0
+            return count
+        elif op in rw:
+            r = self._range(args[0], rw[op])
+            if r is None:
+                self.exc_count += 1
+                return 0
+            if op in (M1N1Proxy.P_READ64, M1N1Proxy.P_READ32):
+                return int.from_bytes(self.mem[r], "little")
+            self.mem[r] = (args[1] & ((1 << (8 * rw[op])) - 1)).to_bytes(rw[op], "little")
+            return 0
+        raise KeyError(op)
+
+    def _run(self):
+        iface = UartInterface
+        sync = 0
+        while True:
+            sync = (sync >> 8) | (self._read(1)[0] << 24)
+            if sync & 0xffffff != 0xaa55ff:
+                continue
+            rtype = sync
+            req = struct.pack("<I", rtype) + self._read(iface.CMD_LEN)
+            csum, = struct.unpack("<I", self._read(4))
+            sync = 0
+            if iface.checksum(None, req) != csum:
+                self._reply(rtype, iface.ST_CSUMERR)
+                continue
+
+            if rtype == iface.REQ_NOP:
+                features, = struct.unpack("<Q", req[4:12])
+                self.data_csums = not (features & 1)
+                self._reply(rtype, iface.ST_OK, struct.pack("<Q", features & 1))
+            elif rtype == iface.REQ_PROXY:
+                op, *args = struct.unpack("<7Q", req[4:60])
+                try:
+                    ret = self._proxy(op, args)
+                except KeyError:
+                    self._reply(rtype, iface.ST_OK, struct.pack("<QqQ", op, M1N1Proxy.S_BADCMD, 0))
+                else:
+                    self._reply(rtype, iface.ST_OK, struct.pack("<QqQ", op, 0, ret))
+            elif rtype == iface.REQ_MEMREAD:
+                addr, size = struct.unpack("<QQ", req[4:20])
+                r = self._range(addr, size)
+                if r is None:
+                    self._reply(rtype, iface.ST_XFERERR)
+                    continue
+                data = bytes(self.mem[r])
+                self._reply(rtype, iface.ST_OK, struct.pack("<I", self._csum(data)))
+                self._send(data + (b"" if self.data_csums else
+                                   struct.pack("<I", iface.DATA_END_SENTINEL)))
+            elif rtype == iface.REQ_MEMWRITE:
+                addr, size, dcsum = struct.unpack("<QQI", req[4:24])
+                data = self._read(size)
+                r = self._range(addr, size)
+                if not self.data_csums:
+                    sentinel, = struct.unpack("<I", self._read(4))
+                    if sentinel != iface.DATA_END_SENTINEL:
+                        r = None
+                if r is None or self._csum(data) != dcsum:
+                    self._reply(rtype, iface.ST_XFERERR)
+                    continue
+                self.mem[r] = data
+                self._reply(rtype, iface.ST_OK, struct.pack("<I", dcsum))
+            else:
+                self._reply(rtype, iface.ST_BADCMD)
+
+    def _csum(self, data):
+        if not self.data_csums:
+            return UartInterface.CHECKSUM_SENTINEL
+        return UartInterface.checksum(None, data)
+
+class NoLock:
+    def acquire(self, prio=None):
+        pass
+    def release(self):
+        pass
+
+parser = argparse.ArgumentParser(description='Stress test concurrent use of one proxy link')
+parser.add_argument('-t', '--threads', type=int, default=4, help="interactive threads")
+parser.add_argument('-b', '--background', type=int, default=2, help="background polling threads")
+parser.add_argument('-s', '--seconds', type=float, default=5)
+parser.add_argument('--unlocked', action="store_true", help="disable the link lock")
+args = parser.parse_args()
+
+target = StandInTarget()
+iface = UartInterface(target)
+iface.dev.timeout = 1
+p = M1N1Proxy(iface)
+iface.nop()
+if args.unlocked:
+    iface.lock = NoLock()
+
+BASE = target.BASE
+COUNTER = BASE + 0xff000
+SLOT = 0x8000
+
+errors = []
+increments = [0]
+latency = {PRIO.INTERACTIVE: [], PRIO.BACKGROUND: []}
+stats_lock = threading.Lock()
+deadline = time.time() + args.seconds
+
+def run(n, prio):
+    rng = random.Random(n)
+    area = BASE + n * SLOT
+    done = 0
+    times = []
+    with iface.priority(prio):
+        while time.time() < deadline:
+            try:
+                t = time.time()
+                if prio == PRIO.BACKGROUND:
+                    # Poll a big range, like RegMonitor, or several like
+                    # MemWatch (sometimes giving up early)
+                    if done % 2:
+                        iface.readmem(BASE, 0x4000)
+                    else:
+                        ranges = [(BASE + i * 0x1000, 0x1000) for i in range(8)]
+                        for i, (addr, data) in enumerate(iface.readmem_many(ranges, window=0x2000)):
+                            if i == rng.randrange(8):
+                                break
+                else:
+                    data = rng.randbytes(rng.randrange(8, SLOT - 8))
+                    iface.writemem(area + 8, data)
+                    if iface.readmem(area + 8, len(data)) != data:
+                        raise Exception("memory round trip mismatch")
+                    p.write64(area, done)
+                    if p.read64(area) != done:
+                        raise Exception("register round trip mismatch")
+                times.append(time.time() - t)
+
+                with iface.exclusive():
+                    val = p.read64(COUNTER)
+                    p.write64(COUNTER, val + 1)
+                done += 1
+            except Exception as e:
+                with stats_lock:
+                    errors.append(f"thread {n}: {e!r}")
+                if len(errors) > 10:
+                    return
+    with stats_lock:
+        increments[0] += done
+        latency[prio].extend(times)
+
+threads = [threading.Thread(target=run, args=(n, PRIO.INTERACTIVE)) for n in range(args.threads)]
+threads += [threading.Thread(target=run, args=(args.threads + n, PRIO.BACKGROUND))
+            for n in range(args.background)]
+for th in threads:
+    th.start()
+for th in threads:
+    th.join()
+
+if not errors:
+    try:
+        counter = p.read64(COUNTER)
+    except Exception as e:
+        errors.append(f"final read: {e!r}")
+    else:
+        if counter != increments[0]:
+            errors.append(f"counter is {counter}, expected {increments[0]}")
+
+for prio, times in latency.items():
+    if times:
+        times.sort()
+        print(f"{prio.name:12} {len(times):6} ops, median {times[len(times) // 2] * 1000:.2f}ms, "
+              f"max {times[-1] * 1000:.2f}ms")
+print(f"{increments[0]} counter increments")
+
+if errors:
+    for e in errors[:10]:
+        print(e)
+    print("FAILED")
+    sys.exit(1)
+print("OK")
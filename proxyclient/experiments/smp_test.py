@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+# Checks that work handed to the secondary CPUs with more jobs than CPUs
+# completes: each CPU has to finish its job before it can take the next one
+# (a job handed to a busy CPU is lost and hangs the target).
+
+from m1n1.setup import *
+from m1n1.find_regs import find_regs, static_regs
+
+cpus = u.secondary_cpus()
+print(f"{len(cpus)} secondary CPUs")
+
+# add x0, x0, x1; str x0, [x2]; ret
+func = u.load_code([0x8b010000, 0xf9000040, 0xd65f03c0])
+buf = u.malloc(8 * 16 * len(cpus))
+try:
+    count = 16 * len(cpus)
+    jobs = [(func, i, 0x1000, buf + 8 * i) for i in range(count)]
+    p.memset64(buf, 0, 8 * count)
+    p.dc_civac(buf, 8 * count)
+    rets = u.smp_run(jobs)
+    p.dc_civac(buf, 8 * count)
+    vals = struct.unpack(f"<{count}Q", iface.readmem(buf, 8 * count))
+    expected = [i + 0x1000 for i in range(count)]
+    assert rets == expected, f"bad return values: {rets}"
+    assert list(vals) == expected, f"bad results: {vals}"
+    print(f"smp_run: {count} jobs OK")
+finally:
+    u.free(func)
+    u.free(buf)
+
+# Small blocks, so that each smp_run gets more blocks than CPUs
+regs = static_regs[:2048]
+ref = set(find_regs(u, regs, values=False))
+smp = set(find_regs(u, regs, block=16, cpus=True, values=False))
+assert ref == smp, f"find_regs differs on the secondaries: {sorted(ref ^ smp)}"
+print(f"find_regs: {len(ref)} registers found, OK")
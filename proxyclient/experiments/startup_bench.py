@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+# Host-side startup benchmark: times imports of the proxyclient modules in
+# fresh interpreters, with the m1n1 cache disabled (M1N1CACHE="", so the
+# sysreg tables are parsed from JSON every time) and with a warm cache, and
+# the imports each tool does before talking to the target. With --device (or
+# $M1N1DEVICE), it also times each tool up to the reply to its first proxy
+# command, including the m1n1.setup session setup.
+
+import argparse, os, subprocess, tempfile
+
+CASES = {
+    "m1n1.sysreg":              "import m1n1.sysreg",
+    "m1n1.sysreg (one reg)":    "import m1n1.sysreg; m1n1.sysreg.HCR_EL2",
+    "m1n1.sysreg (import *)":   "from m1n1.sysreg import *",
+    "m1n1.proxyutils":          "import m1n1.proxyutils",
+    "m1n1.hv":                  "import m1n1.hv",
+}
+
+# Modules each tool imports before its first proxy command; m1n1.setup
+# connects to the target, so without one its own imports are timed instead
+SETUP_IMPORTS = ["m1n1.proxy", "m1n1.proxyutils", "m1n1.sysreg", "m1n1.tgtypes", "m1n1.utils"]
+TOOLS = {
+    "tools/reboot.py":          ["m1n1.setup"],
+    "tools/shell.py":           ["m1n1.setup", "m1n1.shell"],
+    "tools/chainload.py":       ["m1n1.setup", "m1n1.tgtypes", "m1n1.macho", "m1n1.asm"],
+    "tools/linux.py":           ["m1n1.setup"],
+    "tools/run_guest.py":       ["m1n1.proxy", "m1n1.proxyutils", "m1n1.utils", "m1n1.shell", "m1n1.hv"],
+}
+
+def run(stmt, env, runs):
+    code = f"import time; t = time.perf_counter(); {stmt}; print(time.perf_counter() - t)"
+    times = []
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", code], env=env,
+                                      cwd=pathlib.Path(__file__).resolve().parents[1])
+        times.append(float(out))
+    return min(times)
+
+parser = argparse.ArgumentParser(description='Benchmark proxyclient import times')
+parser.add_argument('-n', '--runs', type=int, default=10, help="runs per case (the best is reported)")
+parser.add_argument('-d', '--device', default=os.environ.get("M1N1DEVICE", None),
+                    help="target device, to also time the first proxy command of each tool")
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as cache:
+    cold = dict(os.environ, M1N1CACHE="")
+    warm = dict(os.environ, M1N1CACHE=cache)
+    # Populate the cache
+    run("import m1n1.sysreg; m1n1.sysreg.sysreg_fwd", warm, 1)
+
+    print(f"{'':28} {'no cache':>10} {'cached':>10}")
+    for name, stmt in CASES.items():
+        t_cold = run(stmt, cold, args.runs)
+        t_warm = run(stmt, warm, args.runs)
+        print(f"{name:28} {t_cold * 1000:8.1f}ms {t_warm * 1000:8.1f}ms")
+
+    print()
+    print(f"{'':28} {'imports':>10} {'1st cmd':>10}")
+    for name, mods in TOOLS.items():
+        offline = []
+        for mod in mods:
+            offline.extend(SETUP_IMPORTS if mod == "m1n1.setup" else [mod])
+        t_import = run("import " + ", ".join(offline), warm, args.runs)
+
+        t_first = None
+        if args.device and "m1n1.setup" in mods:
+            env = dict(warm, M1N1DEVICE=args.device)
+            stmt = "import " + ", ".join(mods) + "; m1n1.setup.p.nop()"
+            t_first = run(stmt, env, min(args.runs, 3))
+        first = f"{t_first * 1000:8.1f}ms" if t_first is not None else f"{'-':>10}"
+        print(f"{name:28} {t_import * 1000:8.1f}ms {first}")
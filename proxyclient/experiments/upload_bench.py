@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+# Offline benchmark of the upload path on a real image layout: how much of a
+# kernelcache is elided as zero/pattern fills, and what that saves in host
+# compression time and bytes on the link. Does not need a target.
+
+import argparse, gzip, time
+
+from m1n1.macho import MachO
+from m1n1.upload import find_fill_runs
+
+parser = argparse.ArgumentParser(description='Benchmark sparse uploads of a Mach-O image')
+parser.add_argument('payload', type=pathlib.Path)
+parser.add_argument('--min-run', type=lambda x: int(x, 0), default=0x4000)
+parser.add_argument('--chunk', type=lambda x: int(x, 0), default=4 << 20)
+parser.add_argument('--link-rate', type=float, default=1.5e6 / 10, help="link bytes/s (default: 1.5Mbaud UART)")
+args = parser.parse_args()
+
+macho = MachO(args.payload.open("rb"))
+
+t = time.time()
+image = macho.prepare_image()
+t_layout = time.time() - t
+
+t = time.time()
+runs = find_fill_runs(image, 0, args.min_run)
+t_scan = time.time() - t
+elided = sum(size for off, size, pattern, width in runs)
+
+pieces = []
+pos = 0
+for off, size, pattern, width in runs:
+    if off > pos:
+        pieces.append(image[pos:off])
+    pos = off + size
+pieces.append(image[pos:])
+
+def compress_all(pieces):
+    t = time.time()
+    size = 0
+    for piece in pieces:
+        for off in range(0, len(piece), args.chunk):
+            size += len(gzip.compress(piece[off:off + args.chunk]))
+    return size, time.time() - t
+
+full_size, t_full = compress_all([image])
+sparse_size, t_sparse = compress_all(pieces)
+
+print(f"Image:           0x{len(image):x} bytes (layout in {t_layout:.2f}s)")
+print(f"Fill runs:       {len(runs)} runs, 0x{elided:x} bytes ({100 * elided / len(image):.1f}%), scanned in {t_scan:.2f}s")
+print(f"  memset8:       {sum(1 for r in runs if r[3] == 1)}")
+print(f"  memset64:      {sum(1 for r in runs if r[3] == 8)}")
+print(f"gzip full:       0x{full_size:x} bytes in {t_full:.2f}s, link {full_size / args.link_rate:.1f}s")
+print(f"gzip sparse:     0x{sparse_size:x} bytes in {t_sparse + t_scan:.2f}s, link {sparse_size / args.link_rate:.1f}s")
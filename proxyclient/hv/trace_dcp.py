@@ -48,18 +48,35 @@ class IORingBuf(Reloadable):
         assert wptr is None or wptr == wptr2
 
         rptr = self.state.rptr
+        if wptr2 == rptr:
+            return
+
+        # Fetch the whole pending region in one batch, then parse locally
+        if wptr2 > rptr:
+            spans = [(rptr, wptr2 - rptr)]
+        else:
+            spans = [(rptr, self.state.bufsize - rptr), (0, wptr2)]
+        spans = [(off, size) for off, size in spans if size]
+        views = self.dart.ioreadv([(0, self.base + 0xc0 + off, size) for off, size in spans])
+
+        def fetch(off, size):
+            for (start, length), view in zip(spans, views):
+                if start <= off and off + size <= start + length:
+                    return bytes(view[off - start:off - start + size])
+            return self.dart.ioread(0, self.base + 0xc0 + off, size)
+
         while wptr2 != rptr:
-            hdr = self.dart.ioread(0, self.base + 0xc0 + rptr, 16)
+            hdr = fetch(rptr, 16)
             rptr += 16
             magic, size = struct.unpack("<4sI", hdr[:8])
             assert magic == b"IOP "
             if size > (self.state.bufsize - rptr - 16):
-                hdr = self.dart.ioread(0, self.base + 0xc0, 16)
+                hdr = fetch(0, 16)
                 rptr = 16
                 magic, size = struct.unpack("<4sI", hdr[:8])
                 assert magic == b"IOP "
 
-            payload = self.dart.ioread(0, self.base + 0xc0 + rptr, size)
+            payload = fetch(rptr, size)
             rptr = (align_up(rptr + size, self.align)) % self.state.bufsize
             self.state.rptr = rptr
             yield hdr[8:] + payload
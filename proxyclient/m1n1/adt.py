@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: MIT
-import itertools
+import struct
+from collections.abc import MutableMapping
 from construct import *
 
 from .utils import AddrLookup
@@ -110,40 +111,219 @@ def build_prop(path, name, v, t=None):
 
     return t.build(v)
 
+ADTPropHeader = struct.Struct("<32sI")
+ADTNodeHeader = struct.Struct("<II")
+
+class ADTProperties(MutableMapping):
+    '''Property mapping for an ADTNode.
+
+    Properties are kept as raw slices of the original blob and only decoded
+    (with parse_prop) the first time they are accessed. Properties that are
+    never assigned serialise back to their original bytes.'''
+
+    def __init__(self, node):
+        self._node = node
+        self._raw = {}
+        self._values = {}
+        self._flags = {}
+        self._dirty = False
+
+    def _load(self, name, raw, flags=0):
+        self._raw[name] = raw
+        if flags:
+            self._flags[name] = flags
+
+    def __getitem__(self, name):
+        if name in self._values:
+            return self._values[name]
+
+        raw = self._raw[name]
+        node = self._node
+        try:
+            t, v = parse_prop(node, node._parent_path + self._name(), name, bytes(raw))
+        except Exception as e:
+            print(f"Exception parsing {node._parent_path}{self._name()}.{name} value {bytes(raw).hex()}:")
+            raise
+        node._types[name] = t
+        self._values[name] = v
+        return v
+
+    def _name(self):
+        if "name" not in self._values:
+            raw = self._raw.get("name", None)
+            if raw is None:
+                raise ValueError(f"Node in {self._node._parent_path} has no name!")
+            self._values["name"] = bytes(raw).split(b"\0", 1)[0].decode("ascii")
+            self._node._types["name"] = STD_PROPERTIES["name"]
+        return self._values["name"]
+
+    def __setitem__(self, name, value):
+        if name in self._raw and self._raw[name] is not None and name not in self._values:
+            # Decode first so the original type is known when building
+            self[name]
+        self._raw[name] = None
+        self._values[name] = value
+        self._flags.pop(name, None)
+        self._dirty = True
+        if name == "name" and self._node._parent is not None:
+            self._node._parent._child_index = None
+        self._node._prop_changed(name)
+
+    def __delitem__(self, name):
+        del self._raw[name]
+        self._values.pop(name, None)
+        self._flags.pop(name, None)
+        self._node._types.pop(name, None)
+        self._dirty = True
+        self._node._prop_changed(name)
+
+    def __contains__(self, name):
+        return name in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def build_prop(self, name):
+        '''Return the serialised value of a property and its size flags.'''
+        raw = self._raw[name]
+        if raw is not None:
+            v = self._values.get(name, None)
+            if name not in self._values or isinstance(v, (str, int, bytes, type(None))):
+                return raw, self._flags.get(name, 0)
+            value = build_prop(self._node._path, name, v, t=self._node._types.get(name, None))
+            if value == raw:
+                return raw, self._flags.get(name, 0)
+            return value, 0
+
+        return build_prop(self._node._path, name, self._values[name],
+                          t=self._node._types.get(name, None)), 0
+
+    def modified(self):
+        '''Return True if any property differs from the originally loaded data.'''
+        if self._dirty:
+            return True
+        for name, raw in self._raw.items():
+            if name in self._values and not isinstance(self._values[name], (str, int, bytes, type(None))):
+                if self.build_prop(name)[0] is not raw:
+                    return True
+        return False
+
+class ADTIndex:
+    '''Tree-wide lookup tables for an ADT.
+
+    Maps root-relative paths, compatible strings and AAPL,phandle values to
+    nodes. The index is created lazily on the root node and kept up to date
+    by ADTNode.__setitem__/__delitem__ and by property assignments.'''
+
+    PHANDLE = "AAPL,phandle"
+
+    def __init__(self, root):
+        self.paths = {}
+        self.nodes = {}
+        self.compatible = {}
+        self.phandles = {}
+        self.regs = None
+        self.add(root, "")
+
+    def add(self, node, path):
+        stack = [(node, path)]
+        while stack:
+            node, path = stack.pop()
+            compatible = node._compatible_list()
+            phandle = node._phandle()
+            self.nodes[node] = path, compatible, phandle
+            self.paths.setdefault(path, node)
+            for i in compatible:
+                self.compatible.setdefault(i, []).append(node)
+            if phandle is not None:
+                self.phandles.setdefault(phandle, node)
+
+            prefix = path + "/" if path else ""
+            stack.extend((c, prefix + c.name) for c in reversed(node._children))
+
+        self.regs = None
+
+    def remove(self, node):
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            stack.extend(n._children)
+            if n not in self.nodes:
+                continue
+            path, compatible, phandle = self.nodes.pop(n)
+            if self.paths.get(path, None) is n:
+                del self.paths[path]
+            for i in compatible:
+                nodes = self.compatible[i]
+                nodes.remove(n)
+                if not nodes:
+                    del self.compatible[i]
+            if phandle is not None and self.phandles.get(phandle, None) is n:
+                del self.phandles[phandle]
+
+        self.regs = None
+
+    def reg_lookup(self):
+        if self.regs is None:
+            self.regs = AddrLookup()
+            for node in self.nodes:
+                for index, addr, size in node._regs():
+                    self.regs.add(range(addr, addr + size), (node, index))
+
+        return self.regs
+
 class ADTNode:
     def __init__(self, val=None, path="/", parent=None):
         self._children = []
-        self._properties = {}
         self._types = {}
+        self._properties = ADTProperties(self)
         self._parent_path = path
         self._parent = parent
+        self._child_index = None
+        self._index = None
+        self._blob = None
+        self._span = None
+        self._orig_children = ()
 
         if val is not None:
             for p in val.properties:
-                if p.name == "name":
-                    _name = p.value.decode("ascii").rstrip("\0")
-                    break
-            else:
-                raise ValueError(f"Node in {path} has no name!")
-
-            path = self._parent_path + _name
+                self._properties._load(p.name, p.value)
 
-            for p in val.properties:
-                try:
-                    self._types[p.name], self._properties[p.name] = parse_prop(self, path, p.name, p.value)
-                except Exception as e:
-                    print(f"Exception parsing {path}.{p.name} value {p.value.hex()}:")
-                    raise
-
-            # Second pass
-            for k, v in self._types.items():
-                if v is None:
-                    self._types[k], self._properties[k] = parse_prop(self, path, k, self._properties[k])
+            self._properties._name()
 
             for c in val.children:
                 node = ADTNode(c, f"{self._path}/", parent=self)
                 self._children.append(node)
 
+    @classmethod
+    def _scan(cls, blob, off=0, path="/", parent=None):
+        node = cls(path=path, parent=parent)
+        start = off
+
+        prop_count, child_count = ADTNodeHeader.unpack_from(blob, off)
+        off += ADTNodeHeader.size
+        props = node._properties
+        for i in range(prop_count):
+            name, size = ADTPropHeader.unpack_from(blob, off)
+            off += ADTPropHeader.size
+            vsize = size & 0x7fffffff
+            props._load(name.split(b"\0", 1)[0].decode("ascii"), blob[off:off + vsize],
+                        size & 0x80000000)
+            off += (vsize + 3) & ~3
+
+        child_path = f"{node._path}/"
+        for i in range(child_count):
+            child, off = cls._scan(blob, off, child_path, node)
+            node._children.append(child)
+
+        node._blob = blob
+        node._span = (start, off)
+        node._orig_children = tuple(node._children)
+        return node, off
+
     @property
     def _path(self):
         return self._parent_path + self.name
@@ -153,14 +333,25 @@ class ADTNode:
             while item.startswith("/"):
                 item = item[1:]
             if "/" in item:
+                node = self._lookup_path(item)
+                if node is not None:
+                    return node
                 a, b = item.split("/", 1)
                 return self[a][b]
-            for i in self._children:
-                if i.name == item:
-                    return i
+            index = self._get_child_index()
+            if item in index:
+                return index[item]
             raise KeyError(f"Child node '{item}' not found")
         return self._children[item]
 
+    def _get_child_index(self):
+        if self._child_index is None or self._child_index[0] != len(self._children):
+            index = {}
+            for i in self._children:
+                index.setdefault(i.name, i)
+            self._child_index = len(self._children), index
+        return self._child_index[1]
+
     def __setitem__(self, item, value):
         if isinstance(item, str):
             while item.startswith("/"):
@@ -171,12 +362,18 @@ class ADTNode:
                 return
             for i, c in enumerate(self._children):
                 if c.name == item:
+                    self._tree_remove(c)
                     self._children[i] = value
                     break
             else:
                 self._children.append(value)
+            value._parent = self
+            value._parent_path = f"{self._path}/"
+            self._tree_add(value)
         else:
             self._children[item] = value
+            self._root()._index = None
+        self._child_index = None
 
     def __delitem__(self, item):
         if isinstance(item, str):
@@ -188,11 +385,116 @@ class ADTNode:
                 return
             for i, c in enumerate(self._children):
                 if c.name == item:
+                    self._tree_remove(c)
                     del self._children[i]
+                    self._child_index = None
                     return
             raise KeyError(f"Child node '{item}' not found")
 
         del self._children[item]
+        self._child_index = None
+        self._root()._index = None
+
+    def _root(self):
+        node = self
+        while node._parent is not None:
+            node = node._parent
+        return node
+
+    def _relpath(self):
+        names = []
+        node = self
+        while node._parent is not None:
+            names.append(node.name)
+            node = node._parent
+        return "/".join(reversed(names))
+
+    def _get_tree_index(self):
+        root = self._root()
+        if root._index is None:
+            root._index = ADTIndex(root)
+        return root._index
+
+    def _tree_add(self, node):
+        index = self._root()._index
+        if index is not None and self in index.nodes:
+            index.add(node, node._relpath())
+
+    def _tree_remove(self, node):
+        index = self._root()._index
+        if index is not None:
+            index.remove(node)
+
+    def _prop_changed(self, name):
+        index = self._root()._index
+        if index is None or self not in index.nodes:
+            return
+        if name in ("name", "compatible", ADTIndex.PHANDLE):
+            index.remove(self)
+            index.add(self, self._relpath())
+        elif name in ("reg", "ranges"):
+            index.regs = None
+
+    def _lookup_path(self, path):
+        index = self._get_tree_index()
+        if self not in index.nodes:
+            return None
+        base = index.nodes[self][0]
+        if base:
+            path = base + "/" + path
+        return index.paths.get(path.rstrip("/"), None)
+
+    def _compatible_list(self):
+        props = self._properties
+        if "compatible" not in props:
+            return ()
+        if "compatible" in props._values or props._raw["compatible"] is None:
+            v = props["compatible"]
+            return (v,) if isinstance(v, str) else tuple(v)
+        return tuple(i.decode("ascii", "replace")
+                     for i in bytes(props._raw["compatible"]).split(b"\0") if i)
+
+    def _phandle(self):
+        props = self._properties
+        if ADTIndex.PHANDLE not in props:
+            return None
+        if ADTIndex.PHANDLE in props._values or props._raw[ADTIndex.PHANDLE] is None:
+            return props[ADTIndex.PHANDLE]
+        return int.from_bytes(props._raw[ADTIndex.PHANDLE], "little")
+
+    def find(self, compatible=None, reg_contains=None):
+        '''Find nodes in this subtree.
+
+        compatible: only return nodes listing this compatible string
+        reg_contains: only return nodes with a (translated) reg range containing this address'''
+        index = self._get_tree_index()
+
+        if compatible is not None:
+            nodes = list(index.compatible.get(compatible, ()))
+        else:
+            nodes = None
+
+        if reg_contains is not None:
+            found = []
+            for (node, idx), zone in index.reg_lookup().lookup_all(reg_contains):
+                if node not in found:
+                    found.append(node)
+            if nodes is None:
+                nodes = found
+            else:
+                nodes = [n for n in nodes if n in found]
+
+        if nodes is None:
+            nodes = list(index.nodes)
+
+        if self._parent is not None:
+            base = index.nodes[self][0]
+            nodes = [n for n in nodes if n is self or index.nodes[n][0].startswith(base + "/")]
+
+        return nodes
+
+    def lookup_phandle(self, phandle):
+        return self._get_tree_index().phandles.get(phandle, None)
 
     def __getattr__(self, attr):
         attr = attr.replace("_", "-")
@@ -265,12 +567,12 @@ class ADTNode:
 
     def tostruct(self):
         properties = []
-        for k,v in itertools.chain(self._properties.items()):
-            value = build_prop(self._path, k, v, t=self._types.get(k, None))
+        for k in self._properties:
+            value, flags = self._properties.build_prop(k)
             properties.append({
                 "name": k,
-                "size": len(value),
-                "value": value
+                "size": len(value) | flags,
+                "value": bytes(value)
             })
 
         data = {
@@ -281,34 +583,68 @@ class ADTNode:
         }
         return data
 
+    def modified(self):
+        '''Return True if this subtree differs from the originally loaded data.'''
+        if self._span is None:
+            return True
+        if len(self._children) != len(self._orig_children):
+            return True
+        if any(a is not b for a, b in zip(self._children, self._orig_children)):
+            return True
+        if self._properties.modified():
+            return True
+        return any(c.modified() for c in self._children)
+
+    def _build(self, out):
+        if not self.modified():
+            start, end = self._span
+            out.append(self._blob[start:end])
+            return
+
+        out.append(ADTNodeHeader.pack(len(self._properties), len(self._children)))
+        for k in self._properties:
+            value, flags = self._properties.build_prop(k)
+            out.append(ADTPropHeader.pack(k.encode("ascii"), len(value) | flags))
+            out.append(value)
+            out.append(bytes(-len(value) & 3))
+
+        for c in self._children:
+            c._build(out)
+
     def build(self):
-        return ADTNodeStruct.build(self.tostruct())
+        out = []
+        self._build(out)
+        return b"".join(out)
 
     def walk_tree(self):
         yield self
         for child in self:
             yield from child
 
+    def _regs(self):
+        reg = getattr(self, 'reg', None)
+        if not isinstance(reg, list):
+            return
+
+        for index in range(len(reg)):
+            try:
+                addr, size = self.get_reg(index)
+            except AttributeError:
+                continue
+            if size == 0:
+                continue
+            yield index, addr, size
+
     def build_addr_lookup(self):
         lookup = AddrLookup()
         for node in self.walk_tree():
-            reg = getattr(node, 'reg', None)
-            if not isinstance(reg, list):
-                continue
-
-            for index in range(len(reg)):
-                try:
-                    addr, size = node.get_reg(index)
-                except AttributeError:
-                    continue
-                if size == 0:
-                    continue
+            for index, addr, size in node._regs():
                 lookup.add(range(addr, addr + size), node.name + f"[{index}]")
 
         return lookup
 
 def load_adt(data):
-    return ADTNode(ADTNodeStruct.parse(data))
+    return ADTNode._scan(memoryview(data))[0]
 
 if __name__ == "__main__":
     import sys, argparse, pathlib
@@ -0,0 +1,304 @@
+# SPDX-License-Identifier: MIT
+import collections, marshal, os, selectors, socket, struct, threading, zlib
+from contextlib import contextmanager
+
+from . import proxy
+from .proxy import UartInterface, M1N1Proxy, UartError, ProxyError, LinkLock
+from .proxyutils import ProxyUtils, bootstrap_port
+from .tgtypes import BootArgs
+
+__all__ = ["ProxyDaemon", "DaemonInterface"]
+
+# Messages are marshal'd tuples, each preceded by its length:
+#   request: (op, *args)
+#   reply:   ("ok", result) or ("err", exception class name, message)
+MsgHeader = struct.Struct("<I")
+
+def _send(sock, msg):
+    data = marshal.dumps(msg)
+    sock.sendall(MsgHeader.pack(len(data)) + data)
+
+def _recvfull(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        block = sock.recv(size - len(data))
+        if not block:
+            raise UartError("Connection to the proxy daemon closed")
+        data += block
+    return data
+
+def _recv(sock):
+    size, = MsgHeader.unpack(_recvfull(sock, MsgHeader.size))
+    return marshal.loads(_recvfull(sock, size))
+
+class _Client:
+    def __init__(self, sock):
+        self.sock = sock
+        self.rbuf = bytearray()
+        self.queue = collections.deque()
+        self.arena = None
+
+    def feed(self, data):
+        self.rbuf += data
+        while len(self.rbuf) >= MsgHeader.size:
+            size, = MsgHeader.unpack_from(self.rbuf)
+            if len(self.rbuf) < MsgHeader.size + size:
+                break
+            self.queue.append(marshal.loads(self.rbuf[MsgHeader.size:MsgHeader.size + size]))
+            del self.rbuf[:MsgHeader.size + size]
+
+class ProxyDaemon:
+    '''Owns the link to the target and serves proxy requests to local clients.
+
+    The daemon sets up the link (bootstrap_port) and the ProxyUtils session
+    state once, and keeps it warm: clients get the m1n1 base, boot args and
+    ADT from the daemon without asking the target, and each gets its own
+    heap arena (carved out of the daemon's heap) for its code buffer and
+    allocations, so several tools can share one target.
+
+    Requests are multiplexed at the request level: the daemon queues the
+    requests of each client and serves the clients round-robin, one request
+    at a time. A client can take the link for a sequence of requests (see
+    DaemonInterface.exclusive); the others wait until it is done.
+
+    Target callbacks (exceptions and hypervisor events) are not forwarded,
+    so the hypervisor needs a direct link. So do requests after which the
+    target does not return to this m1n1 (reboots, reloads and booting a
+    kernel): the daemon would keep stale session state for the new m1n1,
+    so they are refused.'''
+
+    ARENA_SIZE = 64 * 1024 * 1024
+    # Requests that do not return to this m1n1
+    LEAVE_OPS = {M1N1Proxy.P_EXIT, M1N1Proxy.P_VECTOR, M1N1Proxy.P_REBOOT, M1N1Proxy.P_KBOOT_BOOT}
+
+    def __init__(self, path, device=None):
+        self.path = path
+        self.iface = UartInterface(device)
+        self.p = M1N1Proxy(self.iface)
+        bootstrap_port(self.iface, self.p)
+        self.u = ProxyUtils(self.p)
+        self.ba_data = self.iface.readmem(self.u.ba_addr, BootArgs.sizeof())
+        self.clients = []
+        self.next = 0
+        self.owner = None
+        self.sel = selectors.DefaultSelector()
+
+    def _adt(self):
+        # Clients can change the ADT on the target (push_adt, the hypervisor
+        # setup), so check that ours is still current before handing it out
+        data = self.u.get_adt()
+        ba = self.u.ba
+        try:
+            crc = self.u.crc32(ba.devtree - ba.virt_base + ba.phys_base, len(data))
+        except ProxyError:
+            crc = None
+        if crc != zlib.crc32(data):
+            self.u.adt_data = None
+            self.u.adt_key = None
+            data = self.u.get_adt()
+        return data
+
+    def _session(self, arena):
+        return {
+            "base": self.u.base,
+            "ba_addr": self.u.ba_addr,
+            "ba": self.ba_data,
+            "heap": (arena, arena + self.ARENA_SIZE),
+            "features": self.iface.enabled_features.value,
+            "adt": self._adt(),
+            "adt_key": self.u.adt_key,
+        }
+
+    def _accept(self, listener):
+        sock, addr = listener.accept()
+        client = _Client(sock)
+        self.clients.append(client)
+        self.sel.register(sock, selectors.EVENT_READ, client)
+
+    def _drop(self, client):
+        self.sel.unregister(client.sock)
+        client.sock.close()
+        self.clients.remove(client)
+        if client.arena is not None:
+            self.u.free(client.arena)
+        if self.owner is client:
+            self.owner = None
+
+    def _pick(self):
+        # The lock owner, if any; otherwise the next client with a request
+        if self.owner is not None:
+            return self.owner if self.owner.queue else None
+        for i in range(len(self.clients)):
+            client = self.clients[(self.next + i) % len(self.clients)]
+            if client.queue:
+                self.next = (self.next + i + 1) % len(self.clients)
+                return client
+        return None
+
+    def _handle(self, client, op, *args):
+        iface = self.iface
+        if op in ("proxyreq", "proxyreq_untimed"):
+            req, reboot, no_reply = args
+            opcode, = struct.unpack_from("<Q", req)
+            if reboot or no_reply or opcode in self.LEAVE_OPS:
+                raise UartError(f"Request 0x{opcode:x} leaves m1n1, which needs a direct link")
+            if op == "proxyreq_untimed":
+                # A long running request: lift the timeout on our link
+                with iface.no_timeout():
+                    return iface.proxyreq(req, reboot=reboot, no_reply=no_reply)
+            return iface.proxyreq(req, reboot=reboot, no_reply=no_reply)
+        elif op == "readmem":
+            return iface.readmem(*args)
+        elif op == "writemem":
+            return iface.writemem(*args)
+        elif op == "nop":
+            return iface.nop()
+        elif op == "lock":
+            self.owner = client
+        elif op == "unlock":
+            self.owner = None
+        elif op == "hello":
+            if client.arena is None:
+                client.arena = self.u.memalign(0x10000, self.ARENA_SIZE)
+            return self._session(client.arena)
+        else:
+            raise ValueError(f"Unknown request {op!r}")
+
+    def _serve(self, client):
+        msg = client.queue.popleft()
+        try:
+            reply = ("ok", self._handle(client, *msg))
+        except Exception as e:
+            reply = ("err", type(e).__name__, str(e))
+        try:
+            _send(client.sock, reply)
+        except OSError:
+            self._drop(client)
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        listener.listen()
+        self.sel.register(listener, selectors.EVENT_READ, None)
+        print(f"Serving m1n1 at 0x{self.u.base:x} on {self.path}")
+
+        try:
+            while True:
+                client = self._pick()
+                events = self.sel.select(0 if client is not None else None)
+                for key, mask in events:
+                    if key.data is None:
+                        self._accept(listener)
+                        continue
+                    try:
+                        data = key.fileobj.recv(65536)
+                    except OSError:
+                        data = b""
+                    if data:
+                        key.data.feed(data)
+                    else:
+                        self._drop(key.data)
+                client = self._pick()
+                if client is not None:
+                    self._serve(client)
+        finally:
+            listener.close()
+            os.unlink(self.path)
+
+class DaemonInterface(UartInterface):
+    '''UartInterface that talks to the target through a ProxyDaemon.
+
+    session holds the warm state from the daemon, to be passed to
+    ProxyUtils. Large memory transfers are split into CHUNK sized requests,
+    so other clients get a turn in between.'''
+
+    CHUNK = 0x100000
+
+    def __init__(self, path=None, debug=False):
+        self.debug = debug
+        self.devpath = path or os.environ["M1N1DAEMON"]
+        self.dev = None
+        self.read_depth = 1
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.devpath)
+        self.tty_enable = False
+        self.handlers = {}
+        self.evt_handlers = {}
+        self.lock = LinkLock()
+        self.prio = threading.local()
+        self._locked = 0
+        self._untimed = 0
+
+        self.session = self._call("hello")
+        self.session["ba"] = BootArgs.parse(self.session["ba"])
+        self.enabled_features = proxy.Feature(self.session["features"])
+
+    def _call(self, op, *args):
+        # Only the local lock: one request is atomic on the daemon side
+        with UartInterface.exclusive(self):
+            _send(self.sock, (op, *args))
+            reply = _recv(self.sock)
+        if reply[0] == "ok":
+            return reply[1]
+        name, msg = reply[1:]
+        exc = getattr(proxy, name, None)
+        if not isinstance(exc, type) or not issubclass(exc, Exception):
+            exc = Exception
+        raise exc(msg)
+
+    @contextmanager
+    def exclusive(self):
+        with super().exclusive():
+            if not self._locked:
+                self._call("lock")
+            self._locked += 1
+            try:
+                yield
+            finally:
+                self._locked -= 1
+                if not self._locked:
+                    self._call("unlock")
+
+    @contextmanager
+    def no_timeout(self):
+        # Our requests run on the daemon's link, so ask it to lift its timeout
+        with UartInterface.exclusive(self):
+            self._untimed += 1
+            try:
+                yield
+            finally:
+                self._untimed -= 1
+
+    def nop(self):
+        self._call("nop")
+
+    def proxyreq(self, req, reboot=False, no_reply=False, pre_reply=None):
+        if pre_reply:
+            raise UartError("pre_reply is not supported through the proxy daemon")
+        op = "proxyreq_untimed" if self._untimed else "proxyreq"
+        return self._call(op, req, reboot, no_reply)
+
+    def writemem(self, addr, data, progress=False):
+        data = memoryview(data)
+        for off in range(0, len(data), self.CHUNK):
+            self._call("writemem", addr + off, bytes(data[off:off + self.CHUNK]))
+
+    def readmem(self, addr, size):
+        return b"".join(self._call("readmem", addr + off, min(self.CHUNK, size - off))
+                        for off in range(0, size, self.CHUNK))
+
+    def readmem_many(self, ranges, depth=None, window=None):
+        for addr, size in ranges:
+            yield addr, self.readmem(addr, size)
+
+    def wait_boot(self):
+        raise UartError("Waiting for the target to boot is not supported through the proxy daemon")
+
+    def ttymode(self, dev=None):
+        raise UartError("TTY mode is not supported through the proxy daemon")
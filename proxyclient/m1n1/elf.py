@@ -0,0 +1,50 @@
+# SPDX-License-Identifier: MIT
+import struct
+
+__all__ = ["ELF"]
+
+ELFHeader = struct.Struct("<16sHHIQQQIHHHHHH")
+ELFSectionHeader = struct.Struct("<IIQQQQIIQQ")
+ELFSym = struct.Struct("<IBBHQQ")
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_ALLOC = 2
+
+class ELF:
+    '''Minimal ELF64 reader, enough to look up symbols and section contents
+    of an m1n1 build (build/m1n1.elf).'''
+
+    def __init__(self, data):
+        self.data = data = memoryview(data).cast("B")
+        ident, etype, machine, version, entry, phoff, shoff, flags, ehsize, \
+            phentsize, phnum, shentsize, shnum, shstrndx = ELFHeader.unpack_from(data)
+        if ident[:4] != b"\x7fELF" or ident[4] != 2:
+            raise Exception("Not an ELF64 file")
+
+        self.sections = [ELFSectionHeader.unpack_from(data, shoff + i * shentsize)
+                         for i in range(shnum)]
+
+        self.symbols = {}
+        for sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, \
+                sh_addralign, sh_entsize in self.sections:
+            if sh_type != SHT_SYMTAB:
+                continue
+            strtab = self.sections[sh_link]
+            strings = bytes(data[strtab[4]:strtab[4] + strtab[5]])
+            for off in range(sh_offset, sh_offset + sh_size, ELFSym.size):
+                st_name, st_info, st_other, st_shndx, st_value, st_size = ELFSym.unpack_from(data, off)
+                if not st_name:
+                    continue
+                name = strings[st_name:strings.index(b"\0", st_name)].decode("ascii")
+                self.symbols[name] = st_value
+
+    def read(self, addr, size):
+        '''return size bytes of section contents at link address addr'''
+        for sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, *rest in self.sections:
+            if sh_type == SHT_NOBITS or not sh_flags & SHF_ALLOC:
+                continue
+            if sh_addr <= addr and addr + size <= sh_addr + sh_size:
+                off = sh_offset + addr - sh_addr
+                return bytes(self.data[off:off + size])
+        raise Exception(f"Address 0x{addr:x} not in any section")
@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: MIT
+import struct
+
+from .proxy import GUARD
+from .proxyutils import GuardedHeap
+
+__all__ = ["find_mmio"]
+
+BAD = 0xacce5515abad1dea
+
+# x0 = address, x1 = stride, x2 = count, x3 = output; stores one u64 per
+# address: the value read, or BAD if the load faulted (and was skipped)
+PROBE_CODE = [
+    0xd283bd46, # movz    x6, #0x1dea
+    0xf2b575a6, # movk    x6, #0xabad, lsl #16
+    0xf2caa2a6, # movk    x6, #0x5515, lsl #32
+    0xf2f599c6, # movk    x6, #0xacce, lsl #48
+    0xb40000e2, # 1: cbz  x2, 2f
+    0xaa0603e5, # mov     x5, x6
+    0xb9400005, # ldr     w5, [x0]
+    0xf8008465, # str     x5, [x3], #8
+    0x8b010000, # add     x0, x0, x1
+    0xd1000442, # sub     x2, x2, #1
+    0x17fffffa, # b       1b
+                # 2:
+]
+PROBE_LOAD = 6
+
+LOADS = {
+    8: 0x39400005,  # ldrb    w5, [x0]
+    16: 0x79400005, # ldrh    w5, [x0]
+    32: 0xb9400005, # ldr     w5, [x0]
+    64: 0xf9400005, # ldr     x5, [x0]
+}
+
+def _probe_code(width):
+    code = list(PROBE_CODE)
+    code[PROBE_LOAD] = LOADS[width]
+    return code
+
+def find_mmio(u, start, end, stride=0x4000, width=32, block=4096, cpus=None, values=True):
+    '''probe the addresses start, start + stride, ... < end with guarded loads,
+    yielding (addr, value) (or just addr) for the ones that respond.
+
+    Each block of addresses is probed by one call of a small routine that
+    stores every value read (or a fault sentinel) into a buffer, which is
+    then read back in one go. With cpus (a list of CPU ids, or True for all
+    secondaries), the blocks are spread over those CPUs with smp_call
+    instead of running on the boot CPU. Only synchronous aborts are caught:
+    an address that raises an asynchronous SError reads as whatever the bus
+    returns.'''
+    p = u.proxy
+    iface = u.iface
+    addrs = range(start, end, stride)
+    blocks = [addrs[i:i + block] for i in range(0, len(addrs), block)]
+    code = _probe_code(width)
+
+    if cpus is True:
+        cpus = u.secondary_cpus()
+
+    def results(buf, blk):
+        data = iface.readmem(buf, 8 * len(blk))
+        for addr, val in zip(blk, struct.unpack(f"<{len(blk)}Q", data)):
+            if val != BAD:
+                if values:
+                    yield addr, val
+                else:
+                    yield addr
+
+    with GuardedHeap(u.heap) as heap:
+        if not cpus:
+            buf = heap.malloc(8 * block)
+            for blk in blocks:
+                u.exec(code, blk.start, stride, len(blk), buf, silent=True, ignore_exceptions=True)
+                yield from results(buf, blk)
+            return
+
+        func = u.load_code(code + [0xd65f03c0]) # ret
+        try:
+            bufs = [heap.malloc(8 * block) for cpu in cpus]
+            # One round of blocks per CPU at a time
+            for i in range(0, len(blocks), len(cpus)):
+                batch = list(zip(bufs, blocks[i:i + len(cpus)]))
+                for buf, blk in batch:
+                    p.dc_civac(buf, 8 * len(blk))
+
+                # The exception guard is global: keep other users of the link out
+                with iface.exclusive():
+                    p.set_exc_guard(GUARD.SKIP | GUARD.SILENT)
+                    try:
+                        u.smp_run([(func, blk.start, stride, len(blk), buf) for buf, blk in batch], cpus)
+                    finally:
+                        p.set_exc_guard(GUARD.OFF)
+
+                for buf, blk in batch:
+                    p.dc_civac(buf, 8 * len(blk))
+                    yield from results(buf, blk)
+        finally:
+            u.free(func)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Probe an MMIO range for responding registers')
+    parser.add_argument('start', type=lambda x: int(x, 0))
+    parser.add_argument('end', type=lambda x: int(x, 0))
+    parser.add_argument('-s', '--stride', type=lambda x: int(x, 0), default=0x4000)
+    parser.add_argument('-w', '--width', type=int, default=32, choices=sorted(LOADS))
+    parser.add_argument('--smp', action="store_true", help="spread the probe over the secondary CPUs")
+    args = parser.parse_args()
+
+    from m1n1.setup import *
+
+    p.iodev_set_usage(IODEV.FB, 0)
+
+    for addr, val in find_mmio(u, args.start, args.end, args.stride, args.width, cpus=args.smp):
+        print(f"{addr:08x}: {val:0{args.width // 4}x}")
@@ -1,10 +1,13 @@
 # SPDX-License-Identifier: MIT
-import struct
+import hashlib, json, os, struct
+from collections import namedtuple
 
-from . import asm, sysreg
-from .proxyutils import GuardedHeap
+from . import sysreg
+from .proxy import GUARD, ProxyError
+from .proxyutils import GuardedHeap, ProxyUtils
+from .utils import cache_path, cache_store
 
-__all__ = ["dynamic_regs", "impdef_regs", "static_regs", "find_regs"]
+__all__ = ["dynamic_regs", "impdef_regs", "static_regs", "find_regs", "reg_access", "RegAccess"]
 
 def _all():
     for op1 in range(1 << 3):
@@ -21,81 +24,237 @@ dynamic_regs = [
 impdef_regs = list(_all())
 static_regs = [i for i in _all() if i not in dynamic_regs]
 
-def find_regs(u, regs=None, block=1024, call=None, values=True):
-    if regs is None:
-        regs = impdef_regs
+RegAccess = namedtuple("RegAccess", "readonly el1 el0")
+
+BAD = 0xacce5515abad1dea
+OOPS = 0xdeadc0dedeadc0de
+# Blocks handed to each secondary per smp_run
+SMP_ROUNDS = 4
+
+MOV = 0xaa0003e2    # mov     x2, x0
+LDR = 0xf9400022    # ldr     x2, [x1]
+STR = 0xf8008422    # str     x2, [x1], #8
+RET = 0xd65f03c0    # ret
+
+# Most registers that fit in one exec() call (12 bytes of code each)
+MAX_BLOCK = (ProxyUtils.CODE_BUFFER_SIZE - 8) // 12
+
+def _sysreg_op(base, enc):
+    op0, op1, CRn, CRm, op2 = enc
+    assert op0 == 3
+    return base | ((op0 & 1) << 19) | (op1 << 16) | (CRn << 12) | (CRm << 8) | (op2 << 5) | 2
+
+def _read_code(regs):
+    # x0 = BAD, x1 = output
+    insns = []
+    for enc in regs:
+        insns.extend((MOV, _sysreg_op(0xd5300000, enc), STR)) # mrs x2, reg
+    return insns
+
+def _cache_key(u, regs, call):
+    chip_id = u.adt["chosen"].chip_id
+    midr = u.mrs("MIDR_EL1")
+    h = hashlib.sha256(repr(list(regs)).encode()).hexdigest()[:16]
+    return f"{chip_id:x}-{midr:x}-{call or 'el2'}-{h}"
 
+def _load_cache(path):
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except Exception:
+        return None
+
+def _matching_cpus(u):
+    # Secondaries of the same core type as the boot CPU; the implementation
+    # defined registers differ between core types.
+    midr = u.mrs("MIDR_EL1")
+    u.proxy.smp_start_secondaries()
+    func = u.load_code([0xd5380000, RET]) # mrs x0, midr_el1
+    try:
+        return [cpu for cpu in u.secondary_cpus() if u.proxy.smp_call_sync(cpu, func) == midr]
+    finally:
+        u.free(func)
+
+def _run(u, buf, regs, call):
+    u.proxy.memset64(buf, OOPS, 8 * len(regs))
+    try:
+        u.exec(_read_code(regs), BAD, buf, call=call, silent=True, ignore_exceptions=True)
+    except ProxyError:
+        return [OOPS] * len(regs)
+    return struct.unpack(f"<{len(regs)}Q", u.iface.readmem(buf, 8 * len(regs)))
+
+def _sweep_smp(u, heap, regs, block, cpus):
+    # Run blocks of registers on the secondaries; returns the registers of
+    # blocks that did not complete, to be retried on the boot CPU.
     p = u.proxy
-    iface = u.iface
+    blocks = [regs[i:i + block] for i in range(0, len(regs), block)]
+    per_run = SMP_ROUNDS * len(cpus)
+    bufs = [heap.malloc(8 * block) for i in range(per_run)]
+    failed = []
+    for i in range(0, len(blocks), per_run):
+        batch = list(zip(bufs, blocks[i:i + per_run]))
+        funcs = []
+        try:
+            for buf, bregs in batch:
+                p.memset64(buf, OOPS, 8 * len(bregs))
+                p.dc_civac(buf, 8 * len(bregs))
+                funcs.append(u.load_code(_read_code(bregs) + [RET]))
 
-    data_len = 8 * block
+            # The exception guard is global: keep other users of the link out
+            with u.iface.exclusive():
+                p.set_exc_guard(GUARD.SKIP | GUARD.SILENT)
+                try:
+                    u.smp_run([(func, BAD, buf) for func, (buf, bregs) in zip(funcs, batch)], cpus)
+                finally:
+                    p.set_exc_guard(GUARD.OFF)
+        finally:
+            for func in funcs:
+                u.free(func)
 
+        for buf, bregs in batch:
+            p.dc_civac(buf, 8 * len(bregs))
+            vals = struct.unpack(f"<{len(bregs)}Q", u.iface.readmem(buf, 8 * len(bregs)))
+            if OOPS in vals:
+                failed.extend(bregs)
+                continue
+            for reg, val in zip(bregs, vals):
+                if val != BAD:
+                    yield reg, val
+    return failed
+
+def _sweep(u, regs, block, call, cpus):
     with GuardedHeap(u.heap) as heap:
-        data_buffer = heap.malloc(data_len)
+        if cpus:
+            if call not in (None, "el2"):
+                raise ValueError("Only EL2 sweeps can run on the secondaries")
+            regs = yield from _sweep_smp(u, heap, regs, block, cpus)
+
+        buf = heap.malloc(8 * MAX_BLOCK)
+        pos = 0
+        while pos < len(regs):
+            bregs = regs[pos:pos + block]
+            vals = _run(u, buf, bregs, call)
+            done = vals.index(OOPS) if OOPS in vals else len(vals)
+            if done == len(bregs):
+                block = min(2 * block, MAX_BLOCK)
+            elif len(bregs) == 1:
+                raise Exception(f"Failed to execute reg-finder code at {bregs[0]}")
+            else:
+                # Keep what completed and bisect the rest
+                block = max(1, (len(bregs) - done) // 2)
+            for reg, val in zip(bregs[:done], vals):
+                if val != BAD:
+                    yield reg, val
+            pos += done
 
-        template = asm.ARMAsm("""
-            mov x2, x0
-            mrs x2, s3_0_c0_c0_0
-            str x2, [x1], #8
-        """, 0x1000)
+def find_regs(u, regs=None, block=1024, call=None, values=True, cpus=None, cache=False):
+    '''find the implemented registers among regs, yielding (reg, value) (or
+    just reg) for each register that can be read.
 
-        mov, mrs, st = struct.unpack("3I", template.data)
+    Registers are read in blocks of generated code, starting at block
+    registers per call; the block size doubles after each block that runs
+    to completion and is halved after one that does not. With cpus (a list of
+    CPU ids, or True for all secondaries of the boot CPU's core type), the
+    sweep is split across those CPUs with smp_call. With cache, the set of
+    implemented registers is remembered per chip, core type and call mode,
+    and later sweeps only read those.'''
+    if regs is None:
+        regs = impdef_regs
+    regs = [sysreg.sysreg_parse(i) for i in regs]
 
-        data = []
+    path = None
+    if cache:
+        path = cache_path("find_regs", _cache_key(u, regs, call) + ".json")
+        present = _load_cache(path)
+        if present is not None:
+            regs = [tuple(i) for i in present]
+            path = cpus = None
 
-        BAD = 0xacce5515abad1dea
-        OOPS = 0xdeadc0dedeadc0de
+    if cpus is True:
+        cpus = _matching_cpus(u)
+
+    found = []
+    for reg, val in _sweep(u, regs, block, call, cpus):
+        found.append(reg)
+        if values:
+            yield reg, val
+        else:
+            yield reg
 
-        rblock = []
-        iregs = iter(regs)
+    if path is not None:
+        cache_store(path, json.dumps(sorted(found)).encode())
 
-        while True:
+def _writable(u, items):
+    # Write each register back with its own value; with GUARD.MARK, a
+    # faulting msr has its source register overwritten with BAD.
+    items = list(items)
+    writable = set()
+    with GuardedHeap(u.heap) as heap:
+        buf = heap.malloc(8 * MAX_BLOCK)
+        for i in range(0, len(items), MAX_BLOCK):
+            batch = items[i:i + MAX_BLOCK]
             insns = []
-            bregs = []
-            for i in iregs:
-                op0, op1, CRn, CRm, op2 = enc = sysreg.sysreg_parse(i)
-                bregs.append(enc)
-                assert op0 == 3
-
-                insns.extend((mov, mrs | (op1 << 16) | (CRn << 12) | (CRm << 8) | (op2 << 5), st))
-
-                if len(bregs) >= block:
-                    break
-
-            if not bregs:
-                break
-
-            p.memset64(data_buffer, OOPS, data_len)
-            u.exec(insns, BAD, data_buffer, call=call, silent=True, ignore_exceptions=True)
-            data = iface.readmem(data_buffer, 8 * len(bregs))
-            for reg, val in zip(bregs, struct.unpack(f"<{len(bregs)}Q", data)):
-                if val == OOPS:
-                    raise Exception(f"Failed to execute reg-finder code at {reg}")
-                if val != BAD:
-                    if values:
-                        yield reg, val
-                    else:
-                        yield reg
+            for reg, val in batch:
+                insns.extend((LDR, _sysreg_op(0xd5100000, reg), STR)) # msr reg, x2
+            u.iface.writemem(buf, struct.pack(f"<{len(batch)}Q", *(val for reg, val in batch)))
+            u.exec(insns, 0, buf, silent=True, ignore_exceptions=True, guard=GUARD.MARK)
+            vals = struct.unpack(f"<{len(batch)}Q", u.iface.readmem(buf, 8 * len(batch)))
+            writable.update(reg for (reg, old), val in zip(batch, vals) if val != BAD)
+    return writable
+
+def reg_access(u, items, cache=False):
+    '''given (reg, value) pairs of registers readable at EL2 (e.g. from
+    find_regs), return {reg: RegAccess(readonly, el1, el0)}.
+
+    Each check is done in batches: one pass writes every register back with
+    its value, and the EL1 and EL0 checks are find_regs sweeps at that level.
+    With cache, the result is remembered per chip and core type.'''
+    items = dict(items)
+    regs = sorted(items)
+
+    path = None
+    if cache:
+        path = cache_path("find_regs", _cache_key(u, regs, "access") + ".json")
+        cached = _load_cache(path)
+        if cached is not None:
+            return {tuple(reg): RegAccess(*access) for reg, *access in cached}
+
+    writable = _writable(u, items.items())
+    el1 = set(find_regs(u, regs, call="el1", values=False))
+    try:
+        el0 = set(find_regs(u, sorted(el1), call="el0", values=False))
+    except Exception:
+        # EL0 code may not be able to store the results; check one by one
+        el0 = set()
+        for reg in el1:
+            try:
+                u.mrs(reg, silent=True, call="el0")
+            except Exception:
+                pass
+            else:
+                el0.add(reg)
+
+    access = {reg: RegAccess(reg not in writable, reg in el1, reg in el0) for reg in regs}
+    if path is not None:
+        cache_store(path, json.dumps([[reg, *a] for reg, a in access.items()]).encode())
+    return access
 
 if __name__ == "__main__":
     from m1n1.setup import *
 
     p.iodev_set_usage(IODEV.FB, 0)
 
-    for reg, val in find_regs(u):
+    regs = dict(find_regs(u, cache=True))
+    access = reg_access(u, regs.items(), cache=True)
+
+    for reg, val in regs.items():
         print(f"{sysreg_name(reg)} ({', '.join(map(str, reg))}) = 0x{val:x}")
 
-        try:
-            u.msr(reg, val, silent=True)
-        except:
+        if access[reg].readonly:
             print(" - READONLY")
-        try:
-            u.mrs(reg, silent=True, call="el1")
-        except:
+        if not access[reg].el1:
             print(" - ### EL2 only ###")
-        try:
-            u.mrs(reg, silent=True, call="el0")
-        except:
-            pass
-        else:
+        if access[reg].el0:
             print(" - *** EL0 accessible ***")
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: MIT
 
 from dataclasses import dataclass
+import functools
 import pprint
 from enum import IntEnum
 
@@ -133,8 +134,13 @@ class Method:
         if out_size % 4:
             self.out_fields.append(Padding(4 - (out_size % 4)))
 
-        self.in_struct = Struct(*self.in_fields)
-        self.out_struct = Struct(*self.out_fields)
+    @functools.cached_property
+    def in_struct(self):
+        return Struct(*self.in_fields)
+
+    @functools.cached_property
+    def out_struct(self):
+        return Struct(*self.out_fields)
 
     def get_field_val(self, i, in_vals, out_vals=None, nullobj=None):
         name, field = self.args[i]
@@ -703,10 +709,18 @@ ALL_CLASSES = [
     MemDescRelay,
 ]
 
-ALL_METHODS = {}
+@functools.cache
+def _all_methods():
+    methods = {}
+    for cls in ALL_CLASSES:
+        methods.update(cls.methods())
+    return methods
 
-for cls in ALL_CLASSES:
-    ALL_METHODS.update(cls.methods())
+def __getattr__(name):
+    # ALL_METHODS is only built when first needed
+    if name == "ALL_METHODS":
+        return _all_methods()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 SHORT_CHANNELS = {
     "CB": "d",
@@ -738,7 +752,7 @@ class Call:
     def print_req(self, indent=""):
         log = f"{indent}{self.dir}{SHORT_CHANNELS[self.chan]}[{self.off:#x}] {self.msg} "
 
-        cls, method = ALL_METHODS.get(self.msg, (None, None))
+        cls, method = _all_methods().get(self.msg, (None, None))
         if cls is None:
             print(log + f"{self.in_size:#x}/{self.out_size:#x}")
             return
@@ -767,7 +781,7 @@ class Call:
         assert self.complete
         log = f"{indent}{RDIR[self.dir]}{SHORT_CHANNELS[self.chan]}[{self.off:#x}] {self.msg} "
 
-        cls, method = ALL_METHODS.get(self.msg, (None, None))
+        cls, method = _all_methods().get(self.msg, (None, None))
         if cls is None:
             print(log + f"{self.in_size:#x}/{self.out_size:#x}")
             return
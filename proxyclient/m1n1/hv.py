@@ -1,5 +1,5 @@
 # SPDX-License-Identifier: MIT
-import sys, traceback, struct, array, bisect, os, signal, runpy
+import sys, traceback, struct, array, bisect, os, signal, runpy, hashlib
 from construct import *
 from enum import Enum, IntEnum, IntFlag
 
@@ -9,6 +9,8 @@ from .proxy import IODEV, START, EVENT, EXC, EXC_RET, ExcInfo
 from .utils import *
 from .sysreg import *
 from .macho import MachO
+from .symbols import SymbolTable
+from .patcher import Patcher
 from .adt import load_adt
 from . import xnutools, shell
 
@@ -109,6 +111,11 @@ class HV(Reloadable):
     IRQTRACE_IRQ = 1
 
     def __init__(self, iface, proxy, utils):
+        from .daemon import DaemonInterface
+        if isinstance(iface, DaemonInterface):
+            # Callbacks are not forwarded, and our heap is only a small arena
+            # of the daemon's (the guest is placed at heap_top)
+            raise Exception("The hypervisor needs a direct link, not a proxy daemon")
         self.iface = iface
         self.p = proxy
         self.u = utils
@@ -119,7 +126,7 @@ class HV(Reloadable):
         self._stepping = False
         self._bps = [None, None, None, None, None]
         self.sym_offset = 0
-        self.symbols = []
+        self.symbols = SymbolTable()
         self.sysreg = {}
         self.novm = False
         self._in_handler = False
@@ -490,30 +497,53 @@ class HV(Reloadable):
             dev = self.interrupt_map[int(evt.num)]
             print(f"IRQ: {dev}: {evt.num}")
 
-    def addr(self, addr):
+    def _no_sym(self, addr, unslid_addr):
+        return self.xnu_mode and (addr < self.tba.virt_base or unslid_addr < self.macho.vmin)
+
+    def _format_addr(self, addr, saddr, name):
         unslid_addr = addr + self.sym_offset
-        if self.xnu_mode and (addr < self.tba.virt_base or unslid_addr < self.macho.vmin):
+        if self._no_sym(addr, unslid_addr):
             return f"0x{addr:x}"
 
-        saddr, name = self.sym(addr)
-
         if name is None:
             return f"0x{addr:x} (0x{unslid_addr:x})"
 
         return f"0x{addr:x} ({name}+0x{unslid_addr - saddr:x})"
 
+    def addr(self, addr):
+        return self._format_addr(addr, *self.sym(addr))
+
+    def addr_many(self, addrs):
+        return [self._format_addr(addr, *sym) for addr, sym in zip(addrs, self.sym_many(addrs))]
+
+    def addr_formatter(self, addrs):
+        '''Symbolise addrs as a batch; returns a function that formats an
+        address like addr(), for code that prints them one at a time.'''
+        addrs = [i for i in addrs if i is not None]
+        names = dict(zip(addrs, self.addr_many(addrs)))
+        return lambda addr: names[addr] if addr in names else self.addr(addr)
 
     def sym(self, addr):
         unslid_addr = addr + self.sym_offset
 
-        if self.xnu_mode and (addr < self.tba.virt_base or unslid_addr < self.macho.vmin):
+        if self._no_sym(addr, unslid_addr):
             return None, None
 
-        idx = bisect.bisect_left(self.symbols, (unslid_addr + 1, "")) - 1
-        if idx < 0 or idx >= len(self.symbols):
-            return None, None
+        return self.symbols.lookup(unslid_addr)
 
-        return self.symbols[idx]
+    def sym_many(self, addrs):
+        '''Symbolise a batch of addresses (e.g. a whole trace) at once.'''
+        result = [(None, None)] * len(addrs)
+        idx, unslid = [], []
+        for i, addr in enumerate(addrs):
+            unslid_addr = addr + self.sym_offset
+            if not self._no_sym(addr, unslid_addr):
+                idx.append(i)
+                unslid.append(unslid_addr)
+
+        for i, sym in zip(idx, self.symbols.lookup_many(unslid)):
+            result[i] = sym
+        return result
 
     def handle_msr(self, ctx, iss=None):
         if iss is None:
@@ -618,20 +648,22 @@ class HV(Reloadable):
             sp_el1 = self.u.mrs(SP_EL1)
             sp_el0 = self.u.mrs(SP_EL0)
             far = None
+            panic = self.sym(elr)[1] == "com.apple.kernel:_panic_trap_to_debugger"
             if esr.EC == ESR_EC.DABORT or esr.EC == ESR_EC.IABORT:
                 far = self.u.mrs(FAR_EL12)
-                if self.sym(elr)[1] != "com.apple.kernel:_panic_trap_to_debugger":
+                if not panic:
                     print("Page fault")
                     return ok
 
-            print(f"EL1: Exception #{vector} ({esr.EC!s}) to {self.addr(target)} from {spsr.M.name}")
-            print(f"     ELR={self.addr(elr)} (0x{elr_phys:x})")
+            addr = self.addr_formatter([target, elr, far])
+            print(f"EL1: Exception #{vector} ({esr.EC!s}) to {addr(target)} from {spsr.M.name}")
+            print(f"     ELR={addr(elr)} (0x{elr_phys:x})")
             print(f"     SP_EL1=0x{sp_el1:x} SP_EL0=0x{sp_el0:x}")
             if far is not None:
-                print(f"     FAR={self.addr(far)}")
+                print(f"     FAR={addr(far)}")
             if elr_phys:
                 self.u.disassemble_at(elr_phys - 4 * 4, 9 * 4, elr_phys)
-            if self.sym(elr)[1] == "com.apple.kernel:_panic_trap_to_debugger":
+            if panic:
                 print("Panic! Trying to decode panic...")
                 try:
                     self.decode_panic_call()
@@ -717,7 +749,7 @@ class HV(Reloadable):
                     handled = self.handle_sync(ctx)
                 elif code == EXC.FIQ:
                     self.u.msr(CNTV_CTL_EL0, 0)
-                    self.u.print_exception(code, ctx)
+                    self.u.print_exception(code, ctx, addr=self.addr_formatter([ctx.elr, ctx.far]))
                     handled = True
             elif reason == START.HV:
                 code = HV_EVENT(code)
@@ -735,7 +767,7 @@ class HV(Reloadable):
                 print("User interrupt")
         else:
             print(f"Guest exception: {reason.name}/{code.name}")
-            self.u.print_exception(code, ctx)
+            self.u.print_exception(code, ctx, addr=self.addr_formatter([ctx.elr, ctx.far]))
 
         if self._sigint_pending or not handled:
 
@@ -823,15 +855,21 @@ class HV(Reloadable):
         if lr is None:
             lr = self.ctx.regs[30] | self.pac_mask
 
-        print("Stack trace:")
-        while frame:
-            print(f" - {self.addr(lr - 4)}")
-            lrp = self.p.hv_translate(frame + 8)
-            fpp = self.p.hv_translate(frame)
-            if not fpp:
-                break
-            lr = self.p.read64(lrp) | self.pac_mask
-            frame = self.p.read64(fpp)
+        # Walk the frames first, then symbolise the return addresses in one go
+        pcs = []
+        try:
+            while frame:
+                pcs.append(lr - 4)
+                lrp = self.p.hv_translate(frame + 8)
+                fpp = self.p.hv_translate(frame)
+                if not fpp:
+                    break
+                lr = self.p.read64(lrp) | self.pac_mask
+                frame = self.p.read64(fpp)
+        finally:
+            print("Stack trace:")
+            for name in self.addr_many(pcs):
+                print(f" - {name}")
 
     def patch_exception_handling(self):
         if self.want_vbar is not None:
@@ -900,7 +938,7 @@ class HV(Reloadable):
         self.adt = load_adt(self.u.get_adt())
         self.iodev = self.p.iodev_whoami()
         self.tba = self.u.ba.copy()
-        self.device_addr_tbl = self.adt.build_addr_lookup()
+        self.device_addr_tbl = self.u.get_adt_addr_lookup()
         self.print_tracer = trace.PrintTracer(self, self.device_addr_tbl)
 
         # disable unused USB iodev early so interrupts can be reenabled in hv_init()
@@ -1076,16 +1114,25 @@ class HV(Reloadable):
             data = open(data, "rb")
 
         self.macho = macho = MachO(data)
-        symbols = None
+        syms = None
         if symfile is not None:
             if isinstance(symfile, str):
                 symfile = open(symfile, "rb")
             syms = MachO(symfile)
-            macho.add_symbols("com.apple.kernel", syms)
             self.xnu_mode = True
 
-        self.symbols = [(v, k) for k, v in macho.symbols.items()]
-        self.symbols.sort()
+        def build_symbols():
+            if syms is not None:
+                macho.add_symbols("com.apple.kernel", syms)
+            return macho.symbols
+
+        if macho.uuid is not None and (syms is None or syms.uuid is not None):
+            key = macho.uuid.hex()
+            if syms is not None:
+                key += "-" + syms.uuid.hex()
+            self.symbols = SymbolTable.cached(key, build_symbols)
+        else:
+            self.symbols = SymbolTable.from_dict(build_symbols())
 
         def load_hook(data, segname, size, fileoff, dest):
             if segname != "__TEXT_EXEC":
@@ -1093,33 +1140,20 @@ class HV(Reloadable):
 
             print(f"Patching segment {segname}...")
 
-            a = array.array("I", data)
-
-            output = []
-
-            p = 0
-            while (p := data.find(b"\x20\x00", p)) != -1:
-                if (p & 3) != 2:
-                    p += 1
-                    continue
-
-                opcode = a[p // 4]
-                inst = self.hvc((opcode & 0xffff))
-                off = fileoff + (p & ~3)
-                if off >= 0xbfcfc0:
-                    print(f"  0x{off:x}: 0x{opcode:04x} -> hvc 0x{opcode:x} (0x{inst:x})")
-                    a[p // 4] = inst
-                p += 4
+            patcher = Patcher()
+            patcher.add("hvc", 0xffff0000, 0x00200000, lambda op: self.hvc(op & 0xffff))
+            data, sites = patcher.apply(data, start=max(0, 0xbfcfc0 - fileoff), cache=True)
+            patcher.report(sites, macho.vmin + dest, self.symbols.lookup)
 
-            print("Done.")
-            return a.tobytes()
+            print(f"Done ({len(sites)} sites).")
+            return data
 
-        #image = macho.prepare_image(load_hook)
-        image = macho.prepare_image()
+        #image = macho.stream_image(load_hook)
+        image = macho.stream_image()
+        image_size = align(macho.image_size)
         sepfw_start, sepfw_length = self.u.adt["chosen"]["memory-map"].SEPFW
         tc_start, tc_size = self.u.adt["chosen"]["memory-map"].TrustCache
 
-        image_size = align(len(image))
         sepfw_off = image_size
         image_size += align(sepfw_length)
         self.bootargs_off = image_size
@@ -1147,10 +1181,10 @@ class HV(Reloadable):
         self.map_hw(0x800000000, 0x800000000, self.u.ba.phys_base - 0x800000000)
         self.map_hw(phys_base, phys_base, self.u.ba.mem_size_actual - phys_base + 0x800000000)
 
-        print(f"Loading kernel image (0x{len(image):x} bytes)...")
-        self.u.compressed_writemem(guest_base, image, True)
-        self.p.dc_cvau(guest_base, len(image))
-        self.p.ic_ivau(guest_base, len(image))
+        print(f"Loading kernel image (0x{macho.image_size:x} bytes)...")
+        self.u.write_image(guest_base, image, True)
+        self.p.dc_cvau(guest_base, macho.image_size)
+        self.p.ic_ivau(guest_base, macho.image_size)
 
         print(f"Copying SEPFW (0x{sepfw_length:x} bytes)...")
         self.p.memcpy8(guest_base + sepfw_off, sepfw_start, sepfw_length)
@@ -1181,12 +1215,18 @@ class HV(Reloadable):
         self.pac_mask = 0xffffffc000000000
         self.sym_offset = 0
         self.xnu_mode = False
-        self.symbols = []
-        with open(path) as fd:
-            for line in fd.readlines():
+        with open(path, "rb") as fd:
+            data = fd.read()
+
+        def build_symbols():
+            symbols = []
+            for line in data.decode("ascii").splitlines():
                 addr, t, name = line.split()
-                self.symbols.append((int(addr, 16), name))
-        self.symbols.sort()
+                symbols.append((int(addr, 16), name))
+            return SymbolTable.from_pairs(symbols)
+
+        key = "sysmap-" + hashlib.sha256(data).hexdigest()
+        self.symbols = SymbolTable.cached(key, build_symbols)
 
     def _handle_sigint(self, signal=None, stack=None):
         self._sigint_pending = True
@@ -1220,7 +1260,13 @@ class HV(Reloadable):
 
         adt_blob = self.adt.build()
         print(f"Uploading ADT (0x{len(adt_blob):x} bytes)...")
-        self.iface.writemem(self.adt_base, adt_blob)
+        # Start from a target-side copy of the original ADT and only send what changed
+        orig_blob = self.u.get_adt()
+        orig_base = self.u.ba.devtree - self.u.ba.virt_base + self.u.ba.phys_base
+        self.p.memcpy8(self.adt_base, orig_base, len(orig_blob))
+        sent = self.u.patchmem(self.adt_base, orig_blob, adt_blob)
+        if sent < len(adt_blob):
+            print(f"  (sent 0x{sent:x} changed bytes)")
 
         print("Shutting down framebuffer...")
         self.p.fb_shutdown(True)
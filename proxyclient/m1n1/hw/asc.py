@@ -1,4 +1,5 @@
 # SPDX-License-Identifier: MIT
+from ..proxy import PRIO
 from ..utils import *
 
 class R_OUTBOX_CTRL(Register32):
@@ -67,21 +68,23 @@ class ASC:
         setattr(self, ep.SHORT, ep)
 
     def work(self):
-        if self.asc.OUTBOX_CTRL.reg.EMPTY:
-            return True
+        # Mailbox polling yields the link to interactive users
+        with self.iface.priority(PRIO.BACKGROUND):
+            if self.asc.OUTBOX_CTRL.reg.EMPTY:
+                return True
 
-        msg0, msg1 = self.recv()
+            msg0, msg1 = self.recv()
 
-        handled = False
+            handled = False
 
-        ep = self.epmap.get(msg1.EP, None)
-        if ep:
-            handled = ep.handle_msg(msg0, msg1)
+            ep = self.epmap.get(msg1.EP, None)
+            if ep:
+                handled = ep.handle_msg(msg0, msg1)
 
-        if not handled:
-            print(f"unknown message: {msg0:#16x} / {msg1}")
+            if not handled:
+                print(f"unknown message: {msg0:#16x} / {msg1}")
 
-        return handled
+            return handled
 
     def work_forever(self):
         while self.work():
@@ -1,6 +1,6 @@
 # SPDX-License-Identifier: MIT
 
-import struct
+import struct, array
 
 from ..utils import *
 from ..malloc import Heap
@@ -69,11 +69,20 @@ class DART(Reloadable):
     Lx_SIZE = (1 << IDX_BITS)
     IDX_MASK = Lx_SIZE - 1
 
+    PTE_ADDR_MASK = ((1 << (PTE.OFFSET[0] + 1)) - 1) & ~((1 << PTE.OFFSET[1]) - 1)
+
+    FLUSH_MERGE_GAP = 32
+    IO_MERGE_GAP = 0x100
+
     def __init__(self, iface, regs, util=None, iova_range=(0x80000000, 0x90000000)):
         self.iface = iface
         self.regs = regs
         self.u = util
         self.pt_cache = {}
+        self.pt_dirty = {}
+        self.pt_owners = {}
+        self.rev_entries = {}
+        self.rev_index = AddrLookup()
         self.iova_allocator = [Heap(iova_range[0], iova_range[1], self.PAGE_SIZE)
                                for i in range(16)]
 
@@ -108,6 +117,86 @@ class DART(Reloadable):
             p += size
             iova += size
 
+    def _iopieces(self, reqs):
+        pieces = []
+        for i, (stream, base, size) in enumerate(reqs):
+            iova = base
+            off = 0
+            for addr, rsize in self.iotranslate(stream, base, size):
+                if addr is None:
+                    raise Exception(f"Unmapped page at iova {iova:#x}")
+                pieces.append((addr, rsize, i, off))
+                iova += rsize
+                off += rsize
+
+        pieces.sort(key=lambda p: p[0])
+        return pieces
+
+    def ioreadv(self, reqs):
+        '''Read a list of (stream, iova, size) regions.
+
+        All regions are translated up front and adjacent (or nearly adjacent)
+        physical ranges are merged, so the whole batch is fetched with as few
+        transfers as possible. Returns one memoryview per request; requests
+        that are physically contiguous are slices of a single backing buffer.'''
+
+        pieces = self._iopieces(reqs)
+
+        runs = []
+        for addr, size, i, off in pieces:
+            if runs and addr <= runs[-1][1] + self.IO_MERGE_GAP:
+                runs[-1][1] = max(runs[-1][1], addr + size)
+            else:
+                runs.append([addr, addr + size])
+
+        buf = bytearray(sum(end - start for start, end in runs))
+        view = memoryview(buf)
+
+        run_pos = []
+        pos = 0
+        for start, end in runs:
+            view[pos:pos + end - start] = self.iface.readmem(start, end - start)
+            run_pos.append((start, end, pos))
+            pos += end - start
+
+        placed = [[] for i in reqs]
+        ri = 0
+        for addr, size, i, off in pieces:
+            while not (run_pos[ri][0] <= addr < run_pos[ri][1]):
+                ri += 1
+            placed[i].append((off, run_pos[ri][2] + addr - run_pos[ri][0], size))
+
+        ret = []
+        for (stream, base, size), parts in zip(reqs, placed):
+            parts.sort()
+            start = parts[0][1] if parts else 0
+            if all(bpos == start + off for off, bpos, psize in parts):
+                ret.append(view[start:start + size])
+            else:
+                ret.append(memoryview(b"".join(view[bpos:bpos + psize]
+                                               for off, bpos, psize in parts)))
+
+        return ret
+
+    def iowritev(self, reqs):
+        '''Write a list of (stream, iova, data) regions, merging writes to
+        physically adjacent ranges into single transfers.'''
+
+        reqs = [(stream, base, memoryview(data).cast("B")) for stream, base, data in reqs]
+        pieces = self._iopieces([(stream, base, len(data)) for stream, base, data in reqs])
+
+        runs = []
+        for addr, size, i, off in pieces:
+            data = reqs[i][2][off:off + size]
+            if runs and addr == runs[-1][0] + runs[-1][1]:
+                runs[-1][1] += size
+                runs[-1][2].append(data)
+            else:
+                runs.append([addr, size, [data]])
+
+        for addr, size, data in runs:
+            self.iface.writemem(addr, b"".join(data))
+
     def iomap(self, stream, addr, size):
         iova = self.iova_allocator[stream].malloc(size)
 
@@ -136,38 +225,48 @@ class DART(Reloadable):
         end = iova + size
         end_page = align_up(end, self.PAGE_SIZE)
 
-        dirty = set()
-
-        for page in range(start_page, end_page, self.PAGE_SIZE):
-            paddr = addr + page - start_page
+        ttbrs = {}
 
+        page = start_page
+        while page < end_page:
             l0 = page >> self.L0_OFF
             assert l0 < self.L0_SIZE
-            ttbr = self.regs.TTBR[stream, l0].reg
-            if not ttbr.VALID:
-                raise Exception(f"L0 page table not ready (TTBR{l0})")
-
-            cached, l1 = self.get_pt(ttbr.ADDR << 12)
+            if l0 not in ttbrs:
+                ttbr = self.regs.TTBR[stream, l0].reg
+                if not ttbr.VALID:
+                    raise Exception(f"L0 page table not ready (TTBR{l0})")
+                ttbrs[l0] = ttbr.ADDR << 12
+            l1addr = ttbrs[l0]
+
+            cached, l1 = self.get_pt(l1addr)
             l1idx = (page >> self.L1_OFF) & self.IDX_MASK
             l1pte = PTE(l1[l1idx])
             if not l1pte.VALID:
                 l2addr = self.u.memalign(self.PAGE_SIZE, self.PAGE_SIZE)
-                self.pt_cache[l2addr] = [0] * self.Lx_SIZE
+                self.pt_cache[l2addr] = array.array("Q", bytes(self.PAGE_SIZE))
+                self.mark_dirty(l2addr, 0, self.Lx_SIZE)
                 l1pte = PTE(
                     OFFSET=l2addr >> self.PAGE_BITS, VALID=1, VALID2=1)
                 l1[l1idx] = l1pte.value
-                dirty.add(ttbr.ADDR << 12)
+                self.mark_dirty(l1addr, l1idx, l1idx + 1)
             else:
                 l2addr = l1pte.OFFSET << self.PAGE_BITS
 
-            dirty.add(l1pte.OFFSET << self.PAGE_BITS)
+            self.own_pt(l2addr, stream, align_down(page, 1 << self.L1_OFF))
             cached, l2 = self.get_pt(l2addr)
             l2idx = (page >> self.L2_OFF) & self.IDX_MASK
-            self.pt_cache[l2addr][l2idx] = PTE(
-                OFFSET=paddr >> self.PAGE_BITS, VALID=1, VALID2=1).value
+            count = min(self.Lx_SIZE - l2idx, (end_page - page) >> self.PAGE_BITS)
+            paddr = addr + page - start_page
+            l2[l2idx:l2idx + count] = self.pte_run(paddr, count)
+            self.mark_dirty(l2addr, l2idx, l2idx + count)
+            self.index_pt(l2addr, l2idx, l2idx + count)
+            page += count << self.PAGE_BITS
+
+        self.flush_dirty()
 
-        for page in dirty:
-            self.flush_pt(page)
+    def pte_run(self, paddr, count):
+        pte = PTE(OFFSET=paddr >> self.PAGE_BITS, VALID=1, VALID2=1).value
+        return array.array("Q", range(pte, pte + count * self.PAGE_SIZE, self.PAGE_SIZE))
 
     def iotranslate(self, stream, start, size):
         if size == 0:
@@ -206,6 +305,7 @@ class DART(Reloadable):
                 pages.append(None)
                 continue
 
+            self.own_pt(l1pte.OFFSET << self.PAGE_BITS, stream, align_down(page, 1 << self.L1_OFF))
             cached, l2 = self.get_pt(l1pte.OFFSET << self.PAGE_BITS)
             l2pte = PTE(l2[(page >> self.L2_OFF) & self.IDX_MASK])
             if not l2pte.VALID and cached:
@@ -242,17 +342,132 @@ class DART(Reloadable):
         cached = True
         if addr not in self.pt_cache or uncached:
             cached = False
-            self.pt_cache[addr] = list(
-                struct.unpack(f"<{self.Lx_SIZE}Q", self.iface.readmem(addr, self.PAGE_SIZE)))
+            self.pt_cache[addr] = array.array("Q", self.iface.readmem(addr, self.PAGE_SIZE))
+            self.pt_dirty.pop(addr, None)
+            if addr in self.pt_owners:
+                self.index_pt(addr)
 
         return cached, self.pt_cache[addr]
 
+    def mark_dirty(self, addr, start, end):
+        self.pt_dirty.setdefault(addr, []).append((start, end))
+
     def flush_pt(self, addr):
         assert addr in self.pt_cache
-        self.iface.writemem(addr, struct.pack(f"<{self.Lx_SIZE}Q", *self.pt_cache[addr]))
+        table = self.pt_cache[addr]
+        spans = sorted(self.pt_dirty.pop(addr, [(0, self.Lx_SIZE)]))
+
+        # Coalesce spans separated by small gaps, a few extra PTEs are cheaper
+        # than another round trip
+        runs = []
+        for start, end in spans:
+            if runs and start <= runs[-1][1] + self.FLUSH_MERGE_GAP:
+                runs[-1][1] = max(runs[-1][1], end)
+            else:
+                runs.append([start, end])
+
+        for start, end in runs:
+            self.iface.writemem(addr + start * 8, table[start:end].tobytes())
+
+    def flush_dirty(self):
+        for addr in list(self.pt_dirty):
+            self.flush_pt(addr)
 
     def invalidate_cache(self):
         self.pt_cache = {}
+        self.pt_dirty = {}
+        self.pt_owners = {}
+        self.rev_entries = {}
+        self.rev_index = AddrLookup()
+
+    def own_pt(self, addr, stream, iova):
+        owners = self.pt_owners.setdefault(addr, set())
+        if (stream, iova) in owners:
+            return
+        owners.add((stream, iova))
+        if addr in self.pt_cache:
+            self.index_pt(addr)
+
+    def index_pt(self, addr, start=0, end=None):
+        '''(Re)index PTEs [start, end) of the cached table at addr in the
+        reverse index (by default the whole table).'''
+        if end is None:
+            end = self.Lx_SIZE
+        entries = self.rev_entries.get(addr, [])
+
+        # Runs that straddle the span are dropped and rescanned in full
+        changed = True
+        while changed:
+            changed = False
+            for first, last, zone, value in entries:
+                if first < end and last > start and (first < start or last > end):
+                    start, end = min(start, first), max(end, last)
+                    changed = True
+
+        keep = []
+        for entry in entries:
+            first, last, zone, value = entry
+            if first < end and last > start:
+                self.rev_index.remove(zone, value)
+            else:
+                keep.append(entry)
+
+        new = []
+        table = self.pt_cache[addr]
+        for stream, base in self.pt_owners.get(addr, ()):
+            run = None
+            for i in range(start, end):
+                pte = table[i]
+                if not (pte & 1):
+                    continue
+                paddr = pte & self.PTE_ADDR_MASK
+                if run and run[0] + run[1] == paddr and run[2] + run[1] == base + i * self.PAGE_SIZE:
+                    run[1] += self.PAGE_SIZE
+                    run[4] = i + 1
+                    continue
+                if run:
+                    new.append(run)
+                run = [paddr, self.PAGE_SIZE, base + i * self.PAGE_SIZE, i, i + 1, stream]
+            if run:
+                new.append(run)
+
+        for paddr, size, iova, first, last, stream in new:
+            zone, value = range(paddr, paddr + size), (stream, iova)
+            self.rev_index.add(zone, value)
+            keep.append((first, last, zone, value))
+        self.rev_entries[addr] = keep
+
+    def build_rev_index(self, streams=range(16)):
+        '''Populate the reverse (physical -> IOVA) index for the given streams.
+
+        Only L2 tables that are referenced by valid L1 entries are read.'''
+        for stream in streams:
+            tcr = self.regs.TCR[stream].reg
+            if tcr.BYPASS_DART or not tcr.TRANSLATE_ENABLE:
+                continue
+
+            for l0, ttbr in enumerate(self.regs.TTBR[stream, :]):
+                ttbr = ttbr.reg
+                if not ttbr.VALID:
+                    continue
+
+                cached, l1 = self.get_pt(ttbr.ADDR << 12)
+                for l1idx, pte in enumerate(l1):
+                    if not (pte & 1):
+                        continue
+                    iova = (l0 << self.L0_OFF) | (l1idx << self.L1_OFF)
+                    self.own_pt(pte & self.PTE_ADDR_MASK, stream, iova)
+                    self.get_pt(pte & self.PTE_ADDR_MASK)
+
+        self.rev_index.compact()
+
+    def iorevtranslate(self, addr):
+        '''Return a list of (stream, iova) pairs that map physical address addr.
+
+        Only tables that have been read or written through this object (or
+        indexed by build_rev_index()) are covered.'''
+        return [(stream, iova + addr - zone.start)
+                for (stream, iova), zone in self.rev_index.lookup_all(addr)]
 
     def dump_table2(self, base, l1_addr):
         cached, tbl = self.get_pt(l1_addr)
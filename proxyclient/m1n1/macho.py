@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: MIT
-from io import BytesIO, SEEK_END, SEEK_SET
-import bisect
+from io import UnsupportedOperation
+from collections.abc import Mapping
+import bisect, mmap, struct
 from construct import *
 
 from .utils import *
@@ -118,23 +119,114 @@ MachOFile = Struct(
     "cmds" / Array(this.header.ncmds, MachOCmd),
 )
 
+# Precompiled layouts for the hot load command types, used instead of the
+# construct definitions above when parsing (those are kept as documentation
+# and for building).
+MachOHeaderStruct = struct.Struct("<8I")
+MachOCmdStruct = struct.Struct("<II")
+MachOSegment64Struct = struct.Struct("<16sQQQQiiII")
+MachOSection64Struct = struct.Struct("<16s16sQQ8I")
+MachOSymTabStruct = struct.Struct("<4I")
+MachOFilesetEntryStruct = struct.Struct("<QQII")
+MachONListStruct = struct.Struct("<IBBhQ")
+
+_CMD_TYPES = MachOLoadCmdType.subcon.decmapping
+_HEADER_FIELDS = ("magic", "cputype", "cpusubtype", "filetype", "ncmds", "sizeofcmds", "flags", "reserved")
+_SECTION_FIELDS = ("addr", "size", "offset", "align", "reloff", "nreloc", "flags",
+                   "reserved1", "reserved2", "reserved3")
+
+def _cstr(b):
+    return bytes(b).split(b"\0", 1)[0].decode("ascii")
+
+def _parse_cmd_args(cmd, data):
+    if cmd == 0x19: # SEGMENT_64
+        segname, *v = MachOSegment64Struct.unpack_from(data)
+        args = Container(segname=_cstr(segname), vmaddr=v[0], vmsize=v[1], fileoff=v[2],
+                         filesize=v[3], maxprot=v[4], initprot=v[5], nsects=v[6], flags=v[7])
+        args.sections = ListContainer()
+        for off in range(MachOSegment64Struct.size, len(data) - MachOSection64Struct.size + 1,
+                         MachOSection64Struct.size):
+            sectname, segname, *v = MachOSection64Struct.unpack_from(data, off)
+            sect = Container(sectname=_cstr(sectname), segname=_cstr(segname))
+            sect.update(zip(_SECTION_FIELDS, v))
+            args.sections.append(sect)
+        return args
+    elif cmd == 0x02: # SYMTAB
+        return Container(zip(("symoff", "nsyms", "stroff", "strsize"), MachOSymTabStruct.unpack_from(data)))
+    elif cmd == 0x1b: # UUID
+        return bytes(data[:16])
+    elif cmd == 0x80000035: # FILESET_ENTRY
+        addr, offset, entryid, reserved = MachOFilesetEntryStruct.unpack_from(data)
+        return Container(addr=addr, offset=offset, entryid=entryid, reserved=reserved,
+                         name=_cstr(data[MachOFilesetEntryStruct.size:]))
+    elif cmd == 0x05: # UNIXTHREAD
+        return MachOCmdUnixThread.parse(bytes(data))
+    else:
+        return bytes(data)
+
+class MachOFileset(Mapping):
+    '''Fileset entries of a MachO, parsed on first access.'''
+    def __init__(self, macho, entries):
+        self._macho = macho
+        self._entries = entries
+        self._files = {}
+
+    def __getitem__(self, name):
+        subfile = self._files.get(name, None)
+        if subfile is None:
+            subfile = MachO(self._macho.data, self._macho.off + self._entries[name])
+            self._files[name] = subfile
+        return subfile
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
 class MachO:
-    def __init__(self, data):
-        if isinstance(data, bytes):
-            self.io = BytesIO(data)
-        else:
-            self.io = data
-
-        self.off = self.io.tell()
-        self.io.seek(0, SEEK_END)
-        self.end = self.io.tell()
+    def __init__(self, data, off=0):
+        '''Parse a Mach-O file from bytes, an mmap, or a file object.
+
+        File objects are mmapped where possible (starting at their current
+        position) so that segment data can be handed out as memoryviews
+        without reading the whole file.'''
+        if hasattr(data, "read"):
+            off += data.tell()
+            try:
+                data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, UnsupportedOperation, ValueError):
+                data.seek(0)
+                data = data.read()
+
+        self.data = memoryview(data).cast("B")
+        self.off = off
+        self.end = len(self.data)
         self.size = self.end - self.off
-        self.io.seek(self.off, SEEK_SET)
-        self.obj = MachOFile.parse_stream(self.io)
+        self.obj = self.parse_cmds()
         self.symbols = {}
         self.load_info()
         self.load_fileset()
 
+    def parse_cmds(self):
+        header = Container(zip(_HEADER_FIELDS, MachOHeaderStruct.unpack_from(self.data, self.off)))
+        cmds = ListContainer()
+        off = self.off + MachOHeaderStruct.size
+        for i in range(header.ncmds):
+            cmd, cmdsize = MachOCmdStruct.unpack_from(self.data, off)
+            args = _parse_cmd_args(cmd, self.data[off + MachOCmdStruct.size:off + cmdsize])
+            cmds.append(Container(cmd=_CMD_TYPES.get(cmd, cmd), args=args))
+            off += cmdsize
+        return Container(header=header, cmds=cmds)
+
+    def read(self, off, size):
+        '''Return a memoryview of size bytes at offset off into this Mach-O.'''
+        return self.data[self.off + off:self.off + off + size]
+
+    def get_segment_data(self, cmd):
+        end = min(self.size, cmd.args.fileoff + cmd.args.filesize)
+        return self.read(cmd.args.fileoff, end - cmd.args.fileoff)
+
     def load_info(self):
         self.vmin, self.vmax = (1 << 64), 0
         self.entry = None
@@ -145,30 +237,62 @@ class MachO:
             elif cmd.cmd == MachOLoadCmdType.UNIXTHREAD:
                 self.entry = cmd.args[0].data.pc
 
-    def prepare_image(self, load_hook=None):
+    def _layout(self):
         memory_size = self.vmax - self.vmin
+        layout = []
 
-        image = bytearray(memory_size)
-
-        for cmd in self.get_cmds(MachOLoadCmdType.SEGMENT_64):
+        segs = sorted(self.get_cmds(MachOLoadCmdType.SEGMENT_64), key=lambda c: c.args.vmaddr)
+        for cmd in segs:
             dest = cmd.args.vmaddr - self.vmin
             end = min(self.size, cmd.args.fileoff + cmd.args.filesize)
             size = end - cmd.args.fileoff
+            clearsize = max(0, cmd.args.vmsize - size)
+            if clearsize and cmd.args.segname == "PYLD":
+                memory_size -= clearsize - 4 # leave a payload end marker
+            layout.append((cmd, dest, size, clearsize))
+
+        return layout, memory_size
+
+    @property
+    def image_size(self):
+        return self._layout()[1]
+
+    def stream_image(self, load_hook=None):
+        '''Yield the memory image as (dest, data, clearsize) tuples.
+
+        data is to be placed at offset dest of the image, followed by clearsize
+        zero bytes. Gaps between segments are yielded as pure zero fills, so
+        the tuples cover the whole image_size without holding it in memory.'''
+        layout, memory_size = self._layout()
+        pos = 0
+
+        for cmd, dest, size, clearsize in layout:
+            if dest > pos:
+                yield pos, b"", dest - pos
+
             print(f"LOAD: {cmd.args.segname} {size} bytes from {cmd.args.fileoff:x} to {dest:x}")
-            self.io.seek(self.off + cmd.args.fileoff)
-            data = self.io.read(size)
+            data = self.read(cmd.args.fileoff, size)
             if load_hook is not None:
-                data = load_hook(data, cmd.args.segname, size, cmd.args.fileoff, dest)
-            image[dest:dest + size] = data
-            if cmd.args.vmsize > size:
-                clearsize = cmd.args.vmsize - size
+                data = load_hook(bytes(data), cmd.args.segname, size, cmd.args.fileoff, dest)
+
+            if clearsize:
                 if cmd.args.segname == "PYLD":
                     print("SKIP: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
-                    memory_size -= clearsize - 4 # leave a payload end marker
-                    image = image[:memory_size]
+                    clearsize = min(clearsize, 4)
                 else:
                     print("ZERO: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
-                    image[dest + size:dest + cmd.args.vmsize] = bytes(clearsize)
+
+            yield dest, data, clearsize
+            pos = max(pos, dest + size + clearsize)
+
+        if pos < memory_size:
+            yield pos, b"", memory_size - pos
+
+    def prepare_image(self, load_hook=None):
+        image = bytearray(self.image_size)
+
+        for dest, data, clearsize in self.stream_image(load_hook):
+            image[dest:dest + len(data)] = data
 
         return image
 
@@ -185,15 +309,26 @@ class MachO:
             raise Exception(f"More than one commands of type {cmdtype} (found {len(cmd)})")
         return cmds[0]
 
+    def _segment_addrs(self, off):
+        # Cheap scan of a fileset entry's segments, without parsing the rest
+        ncmds = MachOHeaderStruct.unpack_from(self.data, self.off + off)[4]
+        off += self.off + MachOHeaderStruct.size
+        for i in range(ncmds):
+            cmd, cmdsize = MachOCmdStruct.unpack_from(self.data, off)
+            if cmd == 0x19:
+                segname, vmaddr = struct.unpack_from("<16sQ", self.data, off + MachOCmdStruct.size)
+                yield _cstr(segname), vmaddr
+            off += cmdsize
+
     def load_fileset(self):
-        self.subfiles = {}
+        entries = {}
 
         for fe in self.get_cmds(MachOLoadCmdType.FILESET_ENTRY):
-            self.io.seek(self.off + fe.args.offset)
-            subfile = MachO(self.io)
-            self.subfiles[fe.args.name] = subfile
-            for seg in subfile.get_cmds(MachOLoadCmdType.SEGMENT_64):
-                self.symbols[f"{fe.args.name}:{seg.args.segname}"] = seg.args.vmaddr
+            entries[fe.args.name] = fe.args.offset
+            for segname, vmaddr in self._segment_addrs(fe.args.offset):
+                self.symbols[f"{fe.args.name}:{segname}"] = vmaddr
+
+        self.subfiles = MachOFileset(self, entries)
 
     def add_symbols(self, filename, syms):
         try:
@@ -228,24 +363,36 @@ class MachO:
         cmd = self.get_cmd(MachOLoadCmdType.SYMTAB)
 
         nsyms = cmd.args.nsyms
-        length = NList.sizeof() * nsyms
-        self.io.seek(self.off + cmd.args.symoff)
-        symdata = self.io.read(length)
-
-        symbols = Array(nsyms, NList).parse(symdata)
-
-        for i in symbols:
-            off = cmd.args.stroff + i.n_strx
-            self.io.seek(self.off + off)
-            name = self.io.read(1024).split(b"\x00")[0].decode("ascii")
-            self.symbols[name] = i.n_value
+        symdata = self.read(cmd.args.symoff, MachONListStruct.size * nsyms)
+        strtab = bytes(self.read(cmd.args.stroff, cmd.args.strsize))
+
+        # Decode the whole string table at once; n_strx values pointing into
+        # the middle of a string (suffix sharing) are looked up individually.
+        strings = {}
+        pos = 0
+        for s in strtab.split(b"\0"):
+            strings[pos] = s
+            pos += len(s) + 1
+
+        for n_strx, n_type, n_sect, n_desc, n_value in MachONListStruct.iter_unpack(symdata):
+            name = strings.get(n_strx, None)
+            if name is None:
+                name = strtab[n_strx:strtab.find(b"\0", n_strx)]
+            self.symbols[name.decode("ascii")] = n_value
+
+    @property
+    def uuid(self):
+        '''The LC_UUID of this file, or None'''
+        for cmd in self.get_cmds(MachOLoadCmdType.UUID):
+            return cmd.args
+        return None
 
 if __name__ == "__main__":
     import sys
-    macho = MachO(open(sys.argv[1], "rb").read())
+    macho = MachO(open(sys.argv[1], "rb"))
 
     if len(sys.argv) > 2:
-        syms = MachO(open(sys.argv[2], "rb").read())
+        syms = MachO(open(sys.argv[2], "rb"))
         macho.add_symbols("com.apple.kernel", syms)
 
         symtab = [(v, k) for (k, v) in macho.symbols.items()]
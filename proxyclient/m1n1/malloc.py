@@ -1,8 +1,16 @@
 # SPDX-License-Identifier: MIT
+import functools, threading
 from contextlib import contextmanager
 
 __all__ = ["Heap"]
 
+def _locked(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
 class Heap(object):
     def __init__(self, start, end, block=64):
         if start%block:
@@ -13,7 +21,9 @@ class Heap(object):
         self.count = (end - start) // block
         self.blocks = [(self.count,False)]
         self.block = block
+        self.lock = threading.Lock()
 
+    @_locked
     def malloc(self, size):
         size = (size + self.block - 1) // self.block
         pos = 0
@@ -26,6 +36,7 @@ class Heap(object):
             pos += bsize
         raise Exception("Out of memory")
 
+    @_locked
     def memalign(self, align, size):
         assert (align & (align - 1)) == 0
         align = max(align, self.block) // self.block
@@ -47,6 +58,7 @@ class Heap(object):
             pos += bsize
         raise Exception("Out of memory")
 
+    @_locked
     def free(self, addr):
         if addr%self.block:
             raise ValueError("free address not aligned")
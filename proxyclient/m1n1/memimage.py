@@ -0,0 +1,235 @@
+# SPDX-License-Identifier: MIT
+import bisect, collections, os, struct, zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from .proxy import ProxyError
+
+__all__ = ["MemImage"]
+
+ImageHeader = struct.Struct("<8sII")
+RecordHeader = struct.Struct("<QQII")
+
+IMAGE_MAGIC = b"m1n1mem\0"
+IMAGE_VERSION = 1
+
+# Record codecs
+ZERO = 0    # all zeroes, no payload
+RAW = 1     # uncompressed payload
+ZLIB = 2    # zlib compressed payload
+FAULT = 3   # could not be read, no payload
+
+def _pack(data):
+    packed = zlib.compress(data, 6)
+    if len(packed) < len(data):
+        return ZLIB, packed
+    return RAW, data
+
+class MemImage:
+    '''Sparse, resumable image of physical memory.
+
+    The file is a header followed by a sequence of records, each covering a
+    block-aligned range of addresses: (addr, size, codec, payload length)
+    and the payload. Zero and unreadable ranges have no payload. Records are
+    only ever appended, so an interrupted capture leaves a valid image
+    (a partially written last record is dropped on open) and capture()
+    simply continues with the ranges that are not covered yet.
+
+        with MemImage("ram.img") as img:
+            img.capture(u, [(dram_base, dram_size)])
+            data = img.read(addr, size)
+    '''
+
+    SCAN_SIZE = 0x4000000
+    READ_SIZE = 0x100000
+
+    def __init__(self, path, block=0x4000):
+        exists = os.path.exists(path)
+        self.fd = open(path, "r+b" if exists else "w+b")
+        self.path = path
+        self.records = []
+        self._starts = []
+
+        if not exists or os.path.getsize(path) == 0:
+            self.block = block
+            self.fd.write(ImageHeader.pack(IMAGE_MAGIC, IMAGE_VERSION, block))
+            self.fd.flush()
+            return
+
+        magic, version, self.block = ImageHeader.unpack(self.fd.read(ImageHeader.size))
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+            raise Exception(f"{path} is not a memory image")
+
+        pos = ImageHeader.size
+        end = os.path.getsize(path)
+        while pos + RecordHeader.size <= end:
+            self.fd.seek(pos)
+            addr, size, codec, length = RecordHeader.unpack(self.fd.read(RecordHeader.size))
+            if pos + RecordHeader.size + length > end:
+                break
+            self._insert((addr, size, codec, pos + RecordHeader.size, length))
+            pos += RecordHeader.size + length
+
+        if pos != end:
+            print(f"{path}: dropping {end - pos} bytes of incomplete data")
+            self.fd.truncate(pos)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.fd.close()
+
+    def _insert(self, rec):
+        i = bisect.bisect(self._starts, rec[0])
+        self._starts.insert(i, rec[0])
+        self.records.insert(i, rec)
+
+    def add(self, addr, size, codec, payload=b""):
+        '''append a record for [addr, addr + size)'''
+        self.fd.seek(0, os.SEEK_END)
+        pos = self.fd.tell()
+        self.fd.write(RecordHeader.pack(addr, size, codec, len(payload)) + payload)
+        self.fd.flush()
+        self._insert((addr, size, codec, pos + RecordHeader.size, len(payload)))
+
+    def covered(self):
+        '''return the merged list of (addr, size) ranges present in the image'''
+        ranges = []
+        for addr, size, *_ in self.records:
+            if ranges and ranges[-1][0] + ranges[-1][1] >= addr:
+                start, rsize = ranges[-1]
+                ranges[-1] = start, max(rsize, addr + size - start)
+            else:
+                ranges.append((addr, size))
+        return ranges
+
+    def missing(self, start, size):
+        '''return the (addr, size) ranges of [start, start + size) not in the image'''
+        end = start + size
+        ranges = []
+        pos = start
+        for addr, rsize in self.covered():
+            if addr + rsize <= pos:
+                continue
+            if addr >= end:
+                break
+            if addr > pos:
+                ranges.append((pos, addr - pos))
+            pos = max(pos, addr + rsize)
+        if pos < end:
+            ranges.append((pos, end - pos))
+        return ranges
+
+    def _record_data(self, rec):
+        addr, size, codec, pos, length = rec
+        if codec == ZERO:
+            return bytes(size)
+        elif codec == FAULT:
+            raise Exception(f"0x{addr:x}..0x{addr + size:x} could not be read")
+        self.fd.seek(pos)
+        payload = self.fd.read(length)
+        if codec == ZLIB:
+            return zlib.decompress(payload)
+        return payload
+
+    def read(self, addr, size):
+        '''read size bytes at addr from the image'''
+        end = addr + size
+        data = bytearray()
+        pos = addr
+        i = max(0, bisect.bisect(self._starts, addr) - 1)
+        for rec in self.records[i:]:
+            raddr, rsize = rec[:2]
+            if raddr >= end:
+                break
+            if raddr + rsize <= pos:
+                continue
+            if raddr > pos:
+                break
+            chunk = self._record_data(rec)
+            data += chunk[pos - raddr:min(end, raddr + rsize) - raddr]
+            pos = raddr + rsize
+            if pos >= end:
+                break
+        if len(data) != size:
+            raise Exception(f"0x{addr + len(data):x} is not in the image")
+        return bytes(data)
+
+    def _scan(self, u, addr, size, plan):
+        # Find the non-zero blocks of [addr, addr + size), recording zero and
+        # unreadable ranges right away; ranges that fault are bisected down to
+        # single blocks.
+        try:
+            blocks = u.nonzero_blocks(addr, size, self.block)
+        except ProxyError:
+            if size <= self.block:
+                self.add(addr, size, FAULT)
+                return
+            half = (size // self.block // 2) * self.block
+            self._scan(u, addr, half, plan)
+            self._scan(u, addr + half, size - half, plan)
+            return
+
+        i = 0
+        while i < len(blocks):
+            j = i
+            while j < len(blocks) and blocks[j] == blocks[i]:
+                j += 1
+            start, run = addr + i * self.block, (j - i) * self.block
+            if blocks[i]:
+                plan.append((start, run))
+            else:
+                self.add(start, run, ZERO)
+            i = j
+
+    def capture(self, u, ranges, read_size=None, depth=None, workers=None, progress=None):
+        '''capture the given (addr, size) ranges from the target into the image.
+
+        Ranges already in the image are skipped. Zero blocks are detected on
+        the target and only recorded; the rest is read with pipelined reads
+        (depth requests in flight, by default the link's read_depth, see
+        UartInterface.readmem_many) and
+        compressed in parallel on the host. progress(done, total) is called
+        after each read.'''
+        read_size = read_size or self.READ_SIZE
+        workers = workers or os.cpu_count() or 1
+        mask = self.block - 1
+
+        todo = []
+        for addr, size in ranges:
+            start, end = addr & ~mask, (addr + size + mask) & ~mask
+            todo.extend(self.missing(start, end - start))
+        total = sum(size for addr, size in todo)
+        done = 0
+
+        plan = []
+        for addr, size in todo:
+            for off in range(0, size, self.SCAN_SIZE):
+                self._scan(u, addr + off, min(self.SCAN_SIZE, size - off), plan)
+        done = total - sum(size for addr, size in plan)
+        if progress:
+            progress(done, total)
+
+        reads = [(addr + off, min(read_size, size - off))
+                 for addr, size in plan for off in range(0, size, read_size)]
+
+        with ProcessPoolExecutor(workers) as pool:
+            pending = collections.deque()
+
+            def flush(limit):
+                nonlocal done
+                while len(pending) > limit:
+                    addr, size, fut = pending.popleft()
+                    self.add(addr, size, *fut.result())
+                    done += size
+                    if progress:
+                        progress(done, total)
+
+            for addr, data in u.iface.readmem_many(reads, depth):
+                pending.append((addr, len(data), pool.submit(_pack, data)))
+                flush(2 * workers)
+            flush(0)
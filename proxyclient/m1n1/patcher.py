@@ -0,0 +1,160 @@
+# SPDX-License-Identifier: MIT
+import array, hashlib, os, pickle, re, struct
+from collections import namedtuple
+
+from .utils import cache_path, cache_store
+
+__all__ = ["Patcher", "PatchRule", "PatchSite"]
+
+PatchRule = namedtuple("PatchRule", "name mask value rewrite")
+PatchSite = namedtuple("PatchSite", "offset rule old new")
+
+def _byte_class(mask, value):
+    if mask == 0xff:
+        return re.escape(bytes([value]))
+    if mask == 0:
+        return b"."
+    return b"[" + b"".join(re.escape(bytes([i])) for i in range(256) if i & mask == value) + b"]"
+
+class Patcher:
+    '''Masked instruction pattern scanner and patch engine for code images.
+
+    Each rule matches 32-bit little-endian instruction words where
+    (word & mask) == value, and rewrites them to either a fixed opcode or
+    the result of calling rewrite(word). Scanning is done over the raw bytes
+    by bytes.find() on the longest fully-masked byte run of the pattern, or by
+    the regex engine (each rule becomes a byte-class pattern) if there is none,
+    so only candidate matches are ever touched from Python.
+
+        p = Patcher()
+        p.add("hvc", 0xffff0000, 0x00200000, lambda op: hv.hvc(op & 0xffff))
+        data, sites = p.apply(data)
+    '''
+
+    def __init__(self):
+        self.rules = []
+        self._matchers = []
+
+    def add(self, name, mask, value, rewrite):
+        '''add a rule; name must uniquely identify the rewrite, as it is part of the cache key'''
+        assert value & ~mask == 0
+        rule = PatchRule(name, mask, value, rewrite)
+        pattern = b"".join(_byte_class((mask >> (8 * i)) & 0xff, (value >> (8 * i)) & 0xff)
+                           for i in range(4))
+
+        # Longest run of exact bytes, usable as a literal search anchor
+        anchor = (0, 0)
+        run = 0
+        for i in range(4):
+            run = run + 1 if (mask >> (8 * i)) & 0xff == 0xff else 0
+            anchor = max(anchor, (run, i + 1 - run))
+        length, pos = anchor
+        literal = struct.pack("<I", value)[pos:pos + length] if length >= 2 else None
+
+        self.rules.append(rule)
+        self._matchers.append((rule, re.compile(pattern, re.DOTALL), literal, pos))
+        return rule
+
+    def brk(self, name, mask, value, imm=0):
+        '''add a rule replacing matching instructions with BRK #imm'''
+        return self.add(name, mask, value, 0xd4200000 | (imm << 5))
+
+    def scan(self, data, start=0, end=None):
+        '''return [(offset, rule, opcode)] for all aligned matches in data[start:end]'''
+        data = memoryview(data).cast("B")
+        if end is None:
+            end = len(data)
+        start = (start + 3) & ~3
+
+        found = {}
+        for rule, regex, literal, anchor in self._matchers:
+            pos = start
+            if literal is not None:
+                buf = data.obj
+                if not isinstance(buf, (bytes, bytearray)) or len(buf) != len(data):
+                    buf = bytes(data)
+                while True:
+                    hit = buf.find(literal, pos + anchor, end)
+                    if hit == -1:
+                        break
+                    off = hit - anchor
+                    if off & 3 or off + 4 > end:
+                        pos = (off | 3) + 1
+                        continue
+                    op = struct.unpack_from("<I", data, off)[0]
+                    if op & rule.mask == rule.value and off not in found:
+                        found[off] = rule, op
+                    pos = off + 4
+                continue
+
+            while True:
+                m = regex.search(data, pos, end)
+                if m is None:
+                    break
+                off = m.start()
+                if off & 3:
+                    pos = (off | 3) + 1
+                    continue
+                if off not in found:
+                    found[off] = rule, struct.unpack_from("<I", data, off)[0]
+                pos = off + 4
+
+        return [(off, rule, op) for off, (rule, op) in sorted(found.items())]
+
+    def sites(self, data, start=0, end=None):
+        '''return the PatchSites that apply() would patch'''
+        sites = []
+        for off, rule, op in self.scan(data, start, end):
+            new = rule.rewrite(op) if callable(rule.rewrite) else rule.rewrite
+            sites.append(PatchSite(off, rule.name, op, new))
+        return sites
+
+    def _cache_key(self, data, start, end):
+        h = hashlib.sha256()
+        h.update(repr([(r.name, r.mask, r.value) for r in self.rules]).encode())
+        h.update(repr((start, end)).encode())
+        h.update(data)
+        return h.hexdigest()
+
+    def apply(self, data, start=0, end=None, cache=False):
+        '''patch data, returning (patched bytes, [PatchSite])
+
+        With cache=True, the patch sites for this exact input and rule set
+        are remembered on disk and reused on the next boot without scanning.'''
+        path = None
+        if cache:
+            path = cache_path("patches", self._cache_key(data, start, end) + ".pickle")
+
+        sites = None
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as fd:
+                    sites = [PatchSite(*i) for i in pickle.load(fd)]
+            except Exception:
+                pass
+
+        if sites is None:
+            sites = self.sites(data, start, end)
+            if path is not None:
+                cache_store(path, pickle.dumps([tuple(i) for i in sites]))
+
+        if not sites:
+            return data, sites
+
+        a = array.array("I")
+        a.frombytes(data[:len(data) & ~3])
+        for site in sites:
+            a[site.offset // 4] = site.new
+        return a.tobytes() + bytes(data[len(data) & ~3:]), sites
+
+    @staticmethod
+    def report(sites, base=0, sym=None):
+        '''print patch sites; sym(addr) -> (symbol address, name) is used to annotate them'''
+        for site in sites:
+            addr = base + site.offset
+            where = ""
+            if sym is not None:
+                saddr, name = sym(addr)
+                if name is not None:
+                    where = f" ({name}+0x{addr - saddr:x})"
+            print(f"  0x{addr:x}{where}: 0x{site.old:08x} -> 0x{site.new:08x} [{site.rule}]")
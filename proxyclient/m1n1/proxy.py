@@ -1,11 +1,12 @@
 # SPDX-License-Identifier: MIT
-import os, sys, struct, serial, time
+import os, sys, struct, serial, time, collections, functools, inspect, threading
+from contextlib import contextmanager
 from construct import *
 from enum import IntEnum, IntFlag
 from serial.tools.miniterm import Miniterm
 
 from .utils import *
-from .sysreg import *
+from .sysreg import ESR, SPSR
 
 __all__ = ["REGION_RWX_EL0", "REGION_RW_EL0", "REGION_RX_EL1"]
 
@@ -32,6 +33,82 @@ class UartChecksumError(UartError):
 class UartRemoteError(UartError):
     pass
 
+class PRIO(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+class LinkLock:
+    '''Reentrant lock for the link, handed out by priority class.
+
+    When the lock is released, the waiter with the lowest PRIO value gets
+    it next (first come, first served within a class), so background work
+    yields to interactive requests at request (or exclusive section)
+    boundaries. So that background work is not starved by a busy
+    interactive user, a waiting lower class gets a turn after it has been
+    passed over MAX_PASS times.'''
+    MAX_PASS = 16
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.owner = None
+        self.depth = 0
+        self.waiters = {prio: collections.deque() for prio in PRIO}
+        self.passed = 0
+
+    def _next(self):
+        waiting = [q for prio, q in sorted(self.waiters.items()) if q]
+        if not waiting:
+            return None
+        if self.passed >= self.MAX_PASS and len(waiting) > 1:
+            return waiting[1]
+        return waiting[0]
+
+    def acquire(self, prio=PRIO.INTERACTIVE):
+        me = threading.get_ident()
+        with self.cond:
+            if self.owner == me:
+                self.depth += 1
+                return
+            self.waiters[prio].append(me)
+            try:
+                while self.owner is not None or self._next()[0] != me:
+                    self.cond.wait()
+            except BaseException:
+                # e.g. KeyboardInterrupt: leave the queue, or the waiters
+                # behind us would wait for us forever
+                self.waiters[prio].remove(me)
+                self.cond.notify_all()
+                raise
+            self.waiters[prio].popleft()
+            if any(q for p, q in self.waiters.items() if p > prio):
+                self.passed += 1
+            else:
+                self.passed = 0
+            self.owner = me
+            self.depth = 1
+
+    def release(self):
+        with self.cond:
+            assert self.owner == threading.get_ident()
+            self.depth -= 1
+            if not self.depth:
+                self.owner = None
+                self.cond.notify_all()
+
+def _exclusive(func):
+    '''decorator for UartInterface methods that must hold the link'''
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.exclusive():
+                return (yield from func(self, *args, **kwargs))
+    else:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.exclusive():
+                return func(self, *args, **kwargs)
+    return wrapper
+
 class Feature(IntFlag):
     DISABLE_DATA_CSUMS = 0x01  # Data transfers don't use checksums
 
@@ -103,6 +180,10 @@ class UartInterface(Reloadable):
     REQ_BOOT = 0x04AA55FF
     REQ_EVENT = 0x05AA55FF
 
+    # Bytes read with the link held by readmem_many, between yields
+    READ_WINDOW = 0x100000
+    # USB (CDC ACM) devices buffer queued commands; a bare UART may not
+    USB_DEVICES = ("/dev/ttyACM", "/dev/cu.usbmodem", "/dev/tty.usbmodem")
     CHECKSUM_SENTINEL = 0xD0DECADE
     DATA_END_SENTINEL = 0xB0CACC10
 
@@ -132,6 +213,10 @@ class UartInterface(Reloadable):
             device = Serial(self.devpath, baud)
 
         self.dev = device
+        # Read requests readmem_many keeps in flight by default
+        self.read_depth = 1
+        if self.devpath and self.devpath.startswith(self.USB_DEVICES):
+            self.read_depth = 2
         self.dev.timeout = 0
         self.dev.flushOutput()
         self.dev.flushInput()
@@ -144,6 +229,8 @@ class UartInterface(Reloadable):
         self.handlers = {}
         self.evt_handlers = {}
         self.enabled_features = Feature(0)
+        self.lock = LinkLock()
+        self.prio = threading.local()
 
     def checksum(self, data):
         sum = 0xDEADBEEF;
@@ -306,6 +393,43 @@ class UartInterface(Reloadable):
     def set_event_handler(self, event_id, handler):
         self.evt_handlers[event_id] = handler
 
+    @contextmanager
+    def exclusive(self):
+        '''keep other users of the link (other threads, or other clients of
+        m1n1.daemon) out while a sequence of requests runs, e.g. one that
+        depends on global target state or a read-modify-write'''
+        self.lock.acquire(self.get_priority())
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def no_timeout(self):
+        '''wait for replies without a timeout, for requests that run for a
+        long time on the target (e.g. decompression)'''
+        with self.exclusive():
+            timeout = self.dev.timeout
+            self.dev.timeout = None
+            try:
+                yield
+            finally:
+                self.dev.timeout = timeout
+
+    def get_priority(self):
+        return getattr(self.prio, "value", PRIO.INTERACTIVE)
+
+    @contextmanager
+    def priority(self, prio):
+        '''run the requests of the current thread with the given PRIO class'''
+        old = self.get_priority()
+        self.prio.value = prio
+        try:
+            yield
+        finally:
+            self.prio.value = old
+
+    @_exclusive
     def wait_boot(self):
         try:
             return self.reply(self.REQ_BOOT)
@@ -327,6 +451,7 @@ class UartInterface(Reloadable):
                 raise UartTimeout("Reconnection timed out")
             print(" Connected")
 
+    @_exclusive
     def nop(self):
         features = Feature.get_all()
 
@@ -344,6 +469,7 @@ class UartInterface(Reloadable):
 
         self.enabled_features = features
 
+    @_exclusive
     def proxyreq(self, req, reboot=False, no_reply=False, pre_reply=None):
         self.cmd(self.REQ_PROXY, req)
         if pre_reply:
@@ -355,6 +481,7 @@ class UartInterface(Reloadable):
         else:
             return self.reply(self.REQ_PROXY)
 
+    @_exclusive
     def writemem(self, addr, data, progress=False):
         checksum = self.data_checksum(data)
         size = len(data)
@@ -377,12 +504,16 @@ class UartInterface(Reloadable):
         # should automatically report a CRC failure
         self.reply(self.REQ_MEMWRITE)
 
+    @_exclusive
     def readmem(self, addr, size):
         if size == 0:
             return b""
 
         req = struct.pack("<QQ", addr, size)
         self.cmd(self.REQ_MEMREAD, req)
+        return self._readmem_data(size)
+
+    def _readmem_data(self, size):
         reply = self.reply(self.REQ_MEMREAD)
         checksum = struct.unpack("<I",reply[:4])[0]
         data = self.readfull(size)
@@ -402,6 +533,54 @@ class UartInterface(Reloadable):
 
         return data
 
+    def readmem_many(self, ranges, depth=None, window=READ_WINDOW):
+        '''yield (addr, data) for each (addr, size) in ranges.
+
+        Up to depth read requests are kept in flight, so the target starts on
+        the next read while the previous one is still being received. This
+        relies on the link buffering the queued commands, which a bare UART
+        with a small FIFO may not do, so the default (read_depth) is 1 except
+        on USB devices.
+
+        The reads are done in windows of about window bytes, each with the
+        link held and all its requests completed before its data is yielded,
+        so the link is free while the caller handles the data.'''
+        if depth is None:
+            depth = self.read_depth
+        it = iter(ranges)
+        done = False
+        while not done:
+            results = []
+            with self.exclusive():
+                pending = collections.deque()
+                queued = 0
+                try:
+                    while True:
+                        while len(pending) < depth and queued < window:
+                            try:
+                                addr, size = next(it)
+                            except StopIteration:
+                                done = True
+                                break
+                            if size == 0:
+                                continue
+                            self.cmd(self.REQ_MEMREAD, struct.pack("<QQ", addr, size))
+                            pending.append((addr, size))
+                            queued += size
+                        if not pending:
+                            break
+                        addr, size = pending[0]
+                        data = self._readmem_data(size)
+                        pending.popleft()
+                        results.append((addr, data))
+                finally:
+                    # Drain requests that were sent but not received (on errors),
+                    # to keep the link in sync
+                    while pending:
+                        addr, size = pending.popleft()
+                        self._readmem_data(size)
+            yield from results
+
     def readstruct(self, addr, stype):
         return stype.parse(self.readmem(addr, stype.sizeof()))
 
@@ -523,6 +702,7 @@ class M1N1Proxy(Reloadable):
     P_SMP_START_SECONDARIES = 0x500
     P_SMP_CALL = 0x501
     P_SMP_CALL_SYNC = 0x502
+    P_SMP_WAIT = 0x503
 
     P_HEAPBLOCK_ALLOC = 0x600
     P_MALLOC = 0x601
@@ -883,6 +1063,9 @@ class M1N1Proxy(Reloadable):
             raise ValueError("Too many arguments")
         return self.request(self.P_SMP_CALL_SYNC, cpu, addr, *args)
 
+    def smp_wait(self, cpu):
+        return self.request(self.P_SMP_WAIT, cpu)
+
     def heapblock_alloc(self, size):
         return self.request(self.P_HEAPBLOCK_ALLOC, size)
     def malloc(self, size):
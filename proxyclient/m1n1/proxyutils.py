@@ -1,17 +1,18 @@
 # SPDX-License-Identifier: MIT
-import serial, os, struct, sys, time, json, os.path, gzip, functools
+import serial, os, re, struct, sys, time, json, os.path, gzip, functools, pickle, zlib, collections, threading, weakref
 from contextlib import contextmanager
 from construct import *
 
-from .asm import ARMAsm
 from .proxy import *
-from .utils import Reloadable, _ascii
+from .utils import Reloadable, _ascii, cache_path, cache_store, diff_ranges
 from .tgtypes import *
-from .sysreg import *
+from .sysreg import ESR, ESR_EC, ESR_ISS_DABORT, ESR_ISS_MSR, MSR_DIR, SPSR, sysreg_name, sysreg_parse
 from .malloc import Heap
+from .upload import UploadPlanner, compress, find_fill_runs
+from .elf import ELF
 from . import adt
 
-__all__ = ["ProxyUtils", "RegMonitor", "GuardedHeap", "bootstrap_port"]
+__all__ = ["ProxyUtils", "RegMonitor", "MemWatch", "GuardedHeap", "bootstrap_port"]
 
 SIMD_B = Array(32, Array(16, Int8ul))
 SIMD_H = Array(32, Array(8, Int16ul))
@@ -21,29 +22,137 @@ SIMD_Q = Array(32, BytesInteger(16, swapped=True))
 
 class ProxyUtils(Reloadable):
     CODE_BUFFER_SIZE = 0x10000
-    def __init__(self, p, heap_size=2 * 1024 * 1024 * 1024):
+
+    # x0 = address, x1 = size; returns the CRC32 of the region (same as zlib.crc32)
+    CRC32_CODE = [
+        0xaa0003e2, # mov     x2, x0
+        0x12800000, # mov     w0, #-1
+        0xf100203f, # 1: cmp  x1, #8
+        0x540000a3, # b.lo    2f
+        0xf8408443, # ldr     x3, [x2], #8
+        0x9ac34c00, # crc32x  w0, w0, x3
+        0xd1002021, # sub     x1, x1, #8
+        0x17fffffb, # b       1b
+        0xb40000a1, # 2: cbz  x1, 3f
+        0x38401443, # ldrb    w3, [x2], #1
+        0x1ac34000, # crc32b  w0, w0, w3
+        0xd1000421, # sub     x1, x1, #1
+        0x17fffffc, # b       2b
+        0x2a2003e0, # 3: mvn  w0, w0
+    ]
+
+    # x0 = address, x1 = size, x2 = block size, x3 = output; writes the CRC32 of
+    # each block (the last one may be short) as an array of u32
+    REGION_CRC32_CODE = [
+        0xb4000261, # 1: cbz  x1, 5f
+        0xeb02003f, # cmp     x1, x2
+        0x9a823024, # csel    x4, x1, x2, lo
+        0xcb040021, # sub     x1, x1, x4
+        0x12800005, # mov     w5, #-1
+        0xf100209f, # 2: cmp  x4, #8
+        0x540000a3, # b.lo    3f
+        0xf8408406, # ldr     x6, [x0], #8
+        0x9ac64ca5, # crc32x  w5, w5, x6
+        0xd1002084, # sub     x4, x4, #8
+        0x17fffffb, # b       2b
+        0xb40000a4, # 3: cbz  x4, 4f
+        0x38401406, # ldrb    w6, [x0], #1
+        0x1ac640a5, # crc32b  w5, w5, w6
+        0xd1000484, # sub     x4, x4, #1
+        0x17fffffc, # b       3b
+        0x2a2503e5, # 4: mvn  w5, w5
+        0xb8004465, # str     w5, [x3], #4
+        0x17ffffee, # b       1b
+                    # 5:
+    ]
+
+    # x0 = address, x1 = block count, x2 = block size (multiple of 64), x3 = output;
+    # writes one byte per block: 0 if the block is all zeroes, 1 otherwise
+    ZERO_SCAN_CODE = [
+        0xb4000321, # 1: cbz  x1, 4f
+        0xaa0203e4, # mov     x4, x2
+        0xa9401c06, # 2: ldp  x6, x7, [x0]
+        0xa9412408, # ldp     x8, x9, [x0, #16]
+        0xa9422c0a, # ldp     x10, x11, [x0, #32]
+        0xa943340c, # ldp     x12, x13, [x0, #48]
+        0x91010000, # add     x0, x0, #64
+        0xd1010084, # sub     x4, x4, #64
+        0xaa0700c6, # orr     x6, x6, x7
+        0xaa090108, # orr     x8, x8, x9
+        0xaa0b014a, # orr     x10, x10, x11
+        0xaa0d018c, # orr     x12, x12, x13
+        0xaa0800c6, # orr     x6, x6, x8
+        0xaa0c014a, # orr     x10, x10, x12
+        0xaa0a00c6, # orr     x6, x6, x10
+        0xb50000a6, # cbnz    x6, 3f
+        0xb5fffe44, # cbnz    x4, 2b
+        0x3800147f, # strb    wzr, [x3], #1
+        0xd1000421, # sub     x1, x1, #1
+        0x17ffffed, # b       1b
+        0x8b040000, # 3: add  x0, x0, x4
+        0x52800026, # mov     w6, #1
+        0x38001466, # strb    w6, [x3], #1
+        0xd1000421, # sub     x1, x1, #1
+        0x17ffffe8, # b       1b
+                    # 4:
+    ]
+
+    # Calls a C function on a secondary CPU, taking the function and its
+    # arguments from a block in memory and storing the return value back:
+    # x0 = block: u64 func, arg0, arg1, arg2, arg3, retval
+    SMP_TRAMPOLINE_CODE = [
+        0xa9bf7bf3, # stp x19, x30, [sp, #-16]!
+        0xaa0003f3, # mov x19, x0
+        0xf9400270, # ldr x16, [x19]
+        0xa9408660, # ldp x0, x1, [x19, #8]
+        0xa9418e62, # ldp x2, x3, [x19, #24]
+        0xd63f0200, # blr x16
+        0xf9001660, # str x0, [x19, #40]
+        0xa8c17bf3, # ldp x19, x30, [sp], #16
+        0xd65f03c0, # ret
+    ]
+
+    # Size of independently compressed chunks for compressed_writemem
+    COMPRESS_CHUNK = 4 * 1024 * 1024
+    # Minimum size of zero/pattern runs that compressed_writemem fills with memset
+    FILL_MIN_RUN = 0x4000
+    # Block size for delta_writemem manifests
+    DELTA_BLOCK = 0x100000
+
+    def __init__(self, p, heap_size=2 * 1024 * 1024 * 1024, session=None):
         self.iface = p.iface
         self.proxy = p
-        self.base = p.get_base()
-        self.ba_addr = p.get_bootargs()
-
-        self.ba = self.iface.readstruct(self.ba_addr, BootArgs)
-
-        # We allocate a 128MB heap, 128MB after the m1n1 heap, without telling it about it.
-        # This frees up from having to coordinate memory management or free stuff after a Python
-        # script runs, at the expense that if m1n1 ever uses more than 128MB of heap it will
-        # clash with Python (m1n1 will normally not use *any* heap when running proxy ops though,
-        # except when running very high-level operations like booting a kernel, so this should be
-        # OK).
-        self.heap_size = heap_size
-        try:
-            self.heap_base = p.heapblock_alloc(0)
-        except ProxyRemoteError:
-            # Compat with versions that don't have heapblock yet
-            self.heap_base = (self.base + ((self.ba.top_of_kernel_data + 0xffff) & ~0xffff) -
-                              self.ba.phys_base)
-        self.heap_base += 128 * 1024 * 1024 # We leave 128MB for m1n1 heap
-        self.heap_top = self.heap_base + self.heap_size
+
+        if session is not None:
+            # Warm state from a proxy daemon (see m1n1.daemon): our heap is the
+            # arena the daemon handed out to us
+            self.base = session["base"]
+            self.ba_addr = session["ba_addr"]
+            self.ba = session["ba"]
+            self.heap_base, self.heap_top = session["heap"]
+            self.heap_size = self.heap_top - self.heap_base
+        else:
+            self.base = p.get_base()
+            self.ba_addr = p.get_bootargs()
+
+            self.ba = self.iface.readstruct(self.ba_addr, BootArgs)
+
+            # We allocate a 128MB heap, 128MB after the m1n1 heap, without telling it about it.
+            # This frees up from having to coordinate memory management or free stuff after a Python
+            # script runs, at the expense that if m1n1 ever uses more than 128MB of heap it will
+            # clash with Python (m1n1 will normally not use *any* heap when running proxy ops though,
+            # except when running very high-level operations like booting a kernel, so this should be
+            # OK).
+            self.heap_size = heap_size
+            try:
+                self.heap_base = p.heapblock_alloc(0)
+            except ProxyRemoteError:
+                # Compat with versions that don't have heapblock yet
+                self.heap_base = (self.base + ((self.ba.top_of_kernel_data + 0xffff) & ~0xffff) -
+                                  self.ba.phys_base)
+            self.heap_base += 128 * 1024 * 1024 # We leave 128MB for m1n1 heap
+            self.heap_top = self.heap_base + self.heap_size
+
         self.heap = Heap(self.heap_base, self.heap_top)
         self.proxy.heap = self.heap
 
@@ -52,8 +161,17 @@ class ProxyUtils(Reloadable):
         self.free = self.heap.free
 
         self.code_buffer = self.malloc(self.CODE_BUFFER_SIZE)
+        self.planner = UploadPlanner()
+        self._m1n1_elf = None
+        self._m1n1_syms = {}
+        self._smp_trampoline = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
         self.adt_data = None
+        self.adt_key = None
+        if session is not None:
+            self.adt_data, self.adt_key = session["adt"], session["adt_key"]
         self.adt = LazyADT(self)
 
         self.simd_buf = self.malloc(32 * 16)
@@ -88,17 +206,19 @@ class ProxyUtils(Reloadable):
     def read(self, addr, width):
         '''do a width read from addr and return it
         width can be 8, 16, 21, 64 or 132'''
-        val = self._read[width](addr)
-        if self.proxy.get_exc_count():
-            raise ProxyError("Exception occurred")
+        with self.iface.exclusive():
+            val = self._read[width](addr)
+            if self.proxy.get_exc_count():
+                raise ProxyError("Exception occurred")
         return val
 
     def write(self, addr, data, width):
         '''do a width write of data to addr
         width can be 8, 16, 21, 64 or 132'''
-        self._write[width](addr, data)
-        if self.proxy.get_exc_count():
-            raise ProxyError("Exception occurred")
+        with self.iface.exclusive():
+            self._write[width](addr, data)
+            if self.proxy.get_exc_count():
+                raise ProxyError("Exception occurred")
 
     def mrs(self, reg, *, silent=False, call=None):
         '''read system register reg'''
@@ -118,7 +238,8 @@ class ProxyUtils(Reloadable):
 
         self.exec(op, val, call=call, silent=silent)
 
-    def exec(self, op, r0=0, r1=0, r2=0, r3=0, *, silent=False, call=None, ignore_exceptions=False):
+    def exec(self, op, r0=0, r1=0, r2=0, r3=0, *, silent=False, call=None, ignore_exceptions=False,
+             guard=GUARD.SKIP):
         if callable(call):
             region = REGION_RX_EL1
         elif isinstance(call, tuple):
@@ -130,6 +251,7 @@ class ProxyUtils(Reloadable):
         elif isinstance(op, int):
             func = struct.pack("<II", op, 0xd65f03c0) # ret
         elif isinstance(op, str):
+            from .asm import ARMAsm
             c = ARMAsm(op + "; ret", self.code_buffer)
             func = c.data
         elif isinstance(op, bytes):
@@ -138,63 +260,465 @@ class ProxyUtils(Reloadable):
             raise ValueError()
 
         assert len(func) < self.CODE_BUFFER_SIZE
-        self.iface.writemem(self.code_buffer, func)
-        self.proxy.dc_cvau(self.code_buffer, len(func))
-        self.proxy.ic_ivau(self.code_buffer, len(func))
-
-        self.proxy.set_exc_guard(GUARD.SKIP | (GUARD.SILENT if silent else 0))
-        ret = call(self.code_buffer | region, r0, r1, r2, r3)
-        if not ignore_exceptions:
-            cnt = self.proxy.get_exc_count()
-            self.proxy.set_exc_guard(GUARD.OFF)
-            if cnt:
-                raise ProxyError("Exception occurred")
-        else:
-            self.proxy.set_exc_guard(GUARD.OFF)
+        # The exception guard and count are global target state
+        with self.iface.exclusive():
+            self.iface.writemem(self.code_buffer, func)
+            self.proxy.dc_cvau(self.code_buffer, len(func))
+            self.proxy.ic_ivau(self.code_buffer, len(func))
+
+            self.proxy.set_exc_guard(guard | (GUARD.SILENT if silent else 0))
+            ret = call(self.code_buffer | region, r0, r1, r2, r3)
+            if not ignore_exceptions:
+                cnt = self.proxy.get_exc_count()
+                self.proxy.set_exc_guard(GUARD.OFF)
+                if cnt:
+                    raise ProxyError("Exception occurred")
+            else:
+                self.proxy.set_exc_guard(GUARD.OFF)
 
         return ret
 
     inst = exec
 
-    def compressed_writemem(self, dest, data, progress):
+    def _compress_pool(self, workers):
+        '''the process pool for _compress_chunks, started on first use (with
+        workers processes) and shared by later calls. It is shut down by
+        close(), or when this object goes away or at exit.'''
+        with self._pool_lock:
+            if self._pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self._pool = ProcessPoolExecutor(workers)
+                self._pool_finalizer = weakref.finalize(self, self._pool.shutdown, wait=False,
+                                                        cancel_futures=True)
+            return self._pool
+
+    def close(self):
+        '''shut down the worker processes started for compressed uploads'''
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool_finalizer()
+                self._pool = None
+
+    def _compress_chunks(self, pieces, chunk_size, codec, workers=None):
+        '''yield (offset, size, codec, payload) for each chunk of the (offset, data) pieces.
+
+        codec is a codec name or a function choosing one per chunk. Chunks are
+        compressed in a process pool, keeping a bounded number (2 * workers)
+        in flight, so later chunks compress while the caller uploads earlier
+        ones. A single chunk is compressed in this process.'''
+        chunks = [(base + off, data[off:off + chunk_size])
+                  for base, data in pieces for off in range(0, len(data), chunk_size)]
+        choose = codec if callable(codec) else lambda chunk: codec
+
+        if not chunks:
+            return
+        elif len(chunks) == 1:
+            off, data = chunks[0]
+            codec = choose(data)
+            yield off, len(data), codec, compress(codec, data)
+            return
+
+        workers = workers or os.cpu_count() or 1
+        pool = self._compress_pool(workers)
+        pending = collections.deque()
+        it = iter(chunks)
+
+        def submit():
+            for off, chunk in it:
+                codec = choose(chunk)
+                if codec == "raw":
+                    payload = chunk
+                else:
+                    payload = pool.submit(compress, codec, bytes(chunk))
+                pending.append((off, len(chunk), codec, payload))
+                return
+
+        try:
+            for i in range(2 * workers):
+                submit()
+            while pending:
+                off, size, codec, payload = pending.popleft()
+                submit()
+                if codec != "raw":
+                    payload = payload.result()
+                yield off, size, codec, payload
+        finally:
+            # Don't leave abandoned chunks queued in the shared pool
+            for off, size, codec, payload in pending:
+                if codec != "raw":
+                    payload.cancel()
+
+    def m1n1_symbol(self, name):
+        '''return the address of a symbol in the running m1n1.
+
+        Symbols are taken from the m1n1 ELF build ($M1N1ELF, or build/m1n1.elf
+        in the source tree), which is checked against the target's memory.'''
+        if name in self._m1n1_syms:
+            return self._m1n1_syms[name]
+
+        path = os.environ.get("M1N1ELF", None)
+        if path is None:
+            path = os.path.join(os.path.dirname(__file__), "..", "..", "build", "m1n1.elf")
+        if self._m1n1_elf is None:
+            with open(path, "rb") as fd:
+                self._m1n1_elf = ELF(fd.read())
+
+        elf = self._m1n1_elf
+        try:
+            value = elf.symbols[name]
+        except KeyError:
+            raise Exception(f"Symbol {name} not found in {path}")
+        addr = self.base + value - elf.symbols.get("_base", 0)
+        if self.iface.readmem(addr, 32) != elf.read(value, 32):
+            raise Exception(f"{path} does not match the running m1n1")
+
+        self._m1n1_syms[name] = addr
+        return addr
+
+    def load_code(self, op):
+        '''copy code (a list of opcodes or bytes) into a new heap buffer and
+        return its address. Unlike exec(), the code must end with its own ret.
+        It is cleaned to the point of coherency, so secondary CPUs (which may
+        run with their caches off) can run it too.'''
+        if isinstance(op, (tuple, list)):
+            op = struct.pack(f"<{len(op)}I", *op)
+        addr = self.malloc(len(op))
+        self.iface.writemem(addr, op)
+        self.proxy.dc_cvac(addr, len(op))
+        self.proxy.ic_ivau(addr, len(op))
+        return addr
+
+    def smp_trampoline(self):
+        if self._smp_trampoline is None:
+            self._smp_trampoline = self.load_code(self.SMP_TRAMPOLINE_CODE)
+        return self._smp_trampoline
+
+    def secondary_cpus(self):
+        return [cpu.cpu_id for cpu in self.adt["cpus"] if cpu.cpu_id != 0]
+
+    def smp_wait(self, cpu):
+        '''wait for cpu to finish its current smp_call job, and return its
+        return value. A CPU must not be given a new job before this.'''
+        return self.proxy.smp_wait(cpu)
+
+    def smp_run(self, jobs, cpus=None):
+        '''run each (addr, *args) in jobs on the secondary CPUs, handing them out
+        round-robin, and wait for all of them to finish. Returns the return
+        values of the jobs, in order.'''
+        if cpus is None:
+            cpus = self.secondary_cpus()
+        if not cpus:
+            raise Exception("no secondary CPUs")
+        self.proxy.smp_start_secondaries()
+        jobs = list(jobs)
+        rets = [None] * len(jobs)
+        busy = {}
+        try:
+            for i, (addr, *args) in enumerate(jobs):
+                cpu = cpus[i % len(cpus)]
+                # A busy CPU would drop the new job
+                if cpu in busy:
+                    rets[busy.pop(cpu)] = self.smp_wait(cpu)
+                self.proxy.smp_call(cpu, addr, *args)
+                busy[cpu] = i
+        finally:
+            for cpu, i in busy.items():
+                rets[i] = self.smp_wait(cpu)
+        return rets
+
+    def measure_link(self, size=32768):
+        '''measure the upload throughput of the link, in bytes per second'''
+        with self.heap.guarded_malloc(size) as addr:
+            t = time.time()
+            self.iface.writemem(addr, os.urandom(size))
+            self.planner.record(size, time.time() - t)
+        return self.planner.link_rate
+
+    def fill_runs(self, dest, runs):
+        '''perform the fills returned by upload.find_fill_runs() on the target'''
+        for off, size, pattern, width in runs:
+            if width == 1:
+                self.proxy.memset8(dest + off, pattern, size)
+            else:
+                self.proxy.memset64(dest + off, pattern, size)
+
+    def compressed_writemem(self, dest, data, progress=False, chunk_size=None, workers=None,
+                            codec="auto", elide=True, smp=False):
+        '''write data to dest, compressed on the host and decompressed on the target.
+
+        With elide, long runs of zeros or of a repeated 64-bit pattern (at
+        least FILL_MIN_RUN bytes) are not sent at all, but filled with memset
+        on the target. The rest is split into independently decodable chunks,
+        compressed in parallel and uploaded/decompressed one by one as they
+        become ready.
+        codec is one of "raw", "gz", "xz" or "auto", which lets the upload
+        planner pick per chunk based on the measured link speed and the
+        chunk's compressibility.
+        progress is either a bool (print dots while uploading) or a callable
+        progress(done, total) called after each chunk.
+        With smp, gzip chunks are decompressed on the secondary CPUs (see
+        SMPDecoder) while the following chunks are uploaded.'''
         if not len(data):
             return
 
-        payload = gzip.compress(data)
-        compressed_size = len(payload)
+        decoder = None
+        if smp:
+            try:
+                decoder = SMPDecoder(self)
+            except Exception as e:
+                print(f"Parallel decompression unavailable ({e}), using the boot CPU")
+
+        data = memoryview(data).cast("B")
+        total = len(data)
+        done = 0
+        chunk_size = chunk_size or self.COMPRESS_CHUNK
+        workers = workers or os.cpu_count() or 1
+
+        pieces = [(0, data)]
+        if elide:
+            runs = find_fill_runs(data, dest, self.FILL_MIN_RUN)
+            if runs:
+                self.fill_runs(dest, runs)
+                pieces = []
+                pos = 0
+                for off, size, pattern, width in runs:
+                    if off > pos:
+                        pieces.append((pos, data[pos:off]))
+                    pos = off + size
+                    done += size
+                if pos < total:
+                    pieces.append((pos, data[pos:]))
+                if callable(progress):
+                    progress(done, total)
+
+        if codec == "auto":
+            if self.planner.link_rate is None:
+                self.measure_link()
+            self.planner.workers = workers
+            codec = self.planner.choose
+
+        for off, size, codec, payload in self._compress_chunks(pieces, chunk_size, codec, workers):
+            if codec == "raw":
+                t = time.time()
+                self.iface.writemem(dest + off, payload, progress is True)
+                self.planner.record(size, time.time() - t)
+            elif codec == "gz" and decoder is not None:
+                compressed_size = len(payload)
+                compressed_addr = self.malloc(compressed_size)
+                t = time.time()
+                self.iface.writemem(compressed_addr, payload, progress is True)
+                self.planner.record(compressed_size, time.time() - t)
+                decoder.submit(compressed_addr, compressed_size, dest + off, size,
+                               functools.partial(self.free, compressed_addr))
+            else:
+                compressed_size = len(payload)
+                with self.heap.guarded_malloc(compressed_size) as compressed_addr:
+                    t = time.time()
+                    self.iface.writemem(compressed_addr, payload, progress is True)
+                    self.planner.record(compressed_size, time.time() - t)
 
-        with self.heap.guarded_malloc(compressed_size) as compressed_addr:
-            self.iface.writemem(compressed_addr, payload, progress)
-            timeout = self.iface.dev.timeout
-            self.iface.dev.timeout = None
+                    with self.iface.no_timeout():
+                        if codec == "gz":
+                            decompressed_size = self.proxy.gzdec(compressed_addr, compressed_size,
+                                                                 dest + off, size)
+                        else:
+                            decompressed_size = self.proxy.xzdec(compressed_addr, compressed_size,
+                                                                 dest + off, size)
+
+                    assert decompressed_size == size
+
+            done += size
+            if callable(progress):
+                progress(done, total)
+
+        if decoder is not None:
+            decoder.finish()
+
+    def memzero(self, addr, size):
+        '''zero size bytes at addr on the target'''
+        head = min(-addr & 7, size)
+        if head:
+            self.proxy.memset8(addr, 0, head)
+        body = (size - head) & ~7
+        if body:
+            self.proxy.memset64(addr + head, 0, body)
+        tail = size - head - body
+        if tail:
+            self.proxy.memset8(addr + head + body, 0, tail)
+
+    def write_image(self, dest, parts, progress=False):
+        '''write a segment stream, as yielded by MachO.stream_image(), to dest.
+
+        File-backed data is uploaded compressed, zero fills are done on the
+        target without sending anything over the link.'''
+        for off, data, clearsize in parts:
+            if len(data):
+                self.compressed_writemem(dest + off, data, progress)
+            if clearsize:
+                self.memzero(dest + off + len(data), clearsize)
+
+    def delta_writemem(self, dest, data, key, block=None, progress=False):
+        '''write data to dest, skipping blocks that are still there from the last upload.
+
+        A manifest of per-block CRC32s of the last upload under key (which
+        should identify the machine and purpose) is kept in the host cache.
+        If any block is unchanged since then, the CRCs of the destination are
+        computed on the target (region_hashes) and only blocks that differ
+        are sent.
+        Returns the number of bytes uploaded.'''
+        block = block or self.DELTA_BLOCK
+        data = memoryview(data).cast("B")
+        hashes = [zlib.crc32(data[off:off + block]) for off in range(0, len(data), block)]
+
+        path = cache_path("delta", key + ".json")
+        manifest = None
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as fd:
+                    manifest = json.load(fd)
+            except Exception:
+                pass
+        if manifest is None or manifest["addr"] != dest or manifest["block"] != block:
+            manifest = {"hashes": []}
+
+        remote = []
+        if any(i == j for i, j in zip(manifest["hashes"], hashes)):
             try:
-                decompressed_size = self.proxy.gzdec(compressed_addr, compressed_size, dest, len(data))
-            finally:
-                self.iface.dev.timeout = timeout
+                remote = self.region_hashes(dest, len(data), block)
+            except ProxyError:
+                pass
+
+        changed = []
+        for i, crc in enumerate(hashes):
+            off = i * block
+            size = min(block, len(data) - off)
+            if i < len(remote) and remote[i] == crc:
+                continue
+            if changed and changed[-1][1] == off:
+                changed[-1][1] = off + size
+            else:
+                changed.append([off, off + size])
 
-            assert decompressed_size == len(data)
+        sent = 0
+        for start, end in changed:
+            self.compressed_writemem(dest + start, data[start:end], progress)
+            sent += end - start
+
+        if path is not None:
+            cache_store(path, json.dumps({"addr": dest, "block": block, "hashes": hashes}).encode())
+
+        return sent
+
+    def crc32(self, addr, size):
+        '''compute the CRC32 of size bytes at addr on the target'''
+        return self.exec(self.CRC32_CODE, addr, size)
+
+    def region_hashes(self, addr, size, block=0x1000):
+        '''compute the CRC32 of each block of size bytes at addr on the target,
+        in a single call. Returns a list of hashes (same as zlib.crc32), the
+        last block may be shorter than block.'''
+        count = (size + block - 1) // block
+        if not count:
+            return []
+        with self.heap.guarded_malloc(count * 4) as buf:
+            self.exec(self.REGION_CRC32_CODE, addr, size, block, buf)
+            return list(struct.unpack(f"<{count}I", self.iface.readmem(buf, count * 4)))
+
+    def nonzero_blocks(self, addr, size, block=0x4000):
+        '''scan size bytes at addr on the target, returning one byte per block:
+        0 if the block is all zeroes, 1 otherwise'''
+        assert block % 64 == 0 and size % block == 0
+        count = size // block
+        with self.heap.guarded_malloc(count) as buf:
+            self.exec(self.ZERO_SCAN_CODE, addr, count, block, buf)
+            return self.iface.readmem(buf, count)
+
+    def _adt_cache(self, suffix):
+        if self.adt_key is None:
+            return None
+        return cache_path("adt", self.adt_key + suffix)
 
     def get_adt(self):
         if self.adt_data is not None:
             return self.adt_data
         adt_base = self.ba.devtree - self.ba.virt_base + self.ba.phys_base
         adt_size = self.ba.devtree_size
+
+        try:
+            crc = self.crc32(adt_base, adt_size)
+        except ProxyError:
+            crc = None
+        else:
+            self.adt_key = f"{adt_size:x}-{crc:08x}"
+
+        path = self._adt_cache(".bin")
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as fd:
+                data = fd.read()
+            if len(data) == adt_size and zlib.crc32(data) == crc:
+                self.adt_data = data
+                return self.adt_data
+
         print(f"Fetching ADT ({adt_size} bytes)...")
         self.adt_data = self.iface.readmem(adt_base, self.ba.devtree_size)
+        if path is not None and zlib.crc32(self.adt_data) == crc:
+            cache_store(path, self.adt_data)
         return self.adt_data
 
+    def get_adt_addr_lookup(self):
+        '''return the address lookup table of the ADT as fetched from the target'''
+        data = self.get_adt()
+        path = self._adt_cache(".lookup.pickle")
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as fd:
+                    return pickle.load(fd)
+            except Exception:
+                pass
+
+        lookup = adt.load_adt(data).build_addr_lookup()
+        if path is not None:
+            cache_store(path, pickle.dumps(lookup))
+        return lookup
+
+    def patchmem(self, addr, old, new, max_ratio=0.5):
+        '''write new to addr, given that the target currently holds old there.
+
+        Only the ranges that differ are sent. If they add up to more than
+        max_ratio of the full size (e.g. because the layout shifted), the whole
+        buffer is written instead. If new is shorter than old, the rest of
+        old is zeroed on the target. Returns the number of bytes sent.'''
+        if len(new) < len(old) and memoryview(old)[len(new):] != bytes(len(old) - len(new)):
+            self.memzero(addr + len(new), len(old) - len(new))
+
+        ranges = diff_ranges(old, new)
+        total = sum(end - start for start, end in ranges)
+        if total > len(new) * max_ratio:
+            self.iface.writemem(addr, new)
+            return len(new)
+
+        new = memoryview(new)
+        for start, end in ranges:
+            self.iface.writemem(addr + start, new[start:end])
+        return total
+
     def push_adt(self):
-        self.adt_data = self.adt.build()
+        old = self.get_adt()
+        new = self.adt.build()
         adt_base = self.ba.devtree - self.ba.virt_base + self.ba.phys_base
-        adt_size = len(self.adt_data)
-        print(f"Pushing ADT ({adt_size} bytes)...")
-        self.iface.writemem(adt_base, self.adt_data)
+        print(f"Pushing ADT ({len(new)} bytes)...")
+        sent = self.patchmem(adt_base, old, new)
+        if sent < len(new):
+            print(f"  (sent {sent} changed bytes)")
+        self.adt_data = new
+        self.adt_key = None
 
     def disassemble_at(self, start, size, pc=None):
         '''disassemble len bytes of memory from start
          optional pc address will mark that line with a '*' '''
         code = struct.unpack(f"<{size // 4}I", self.iface.readmem(start, size))
 
+        from .asm import ARMAsm
         c = ARMAsm(".inst " + ",".join(str(i) for i in code), start)
         lines = list(c.disassemble())
         if pc is not None:
@@ -229,12 +753,9 @@ class ProxyUtils(Reloadable):
                 if ctx.esr.EC == ESR_EC.MSR:
                     iss = ESR_ISS_MSR(ctx.esr.ISS)
                 else:
-                    iss = ESR_ISS_MSR(self.mrs(AFSR1_EL2))
+                    iss = ESR_ISS_MSR(self.mrs("AFSR1_EL2"))
                 enc = iss.Op0, iss.Op1, iss.CRn, iss.CRm, iss.Op2
-                if enc in sysreg_rev:
-                    name = sysreg_rev[enc]
-                else:
-                    name = f"s{iss.Op0}_{iss.Op1}_c{iss.CRn}_c{iss.CRm}_{iss.Op2}"
+                name = sysreg_name(enc)
                 if iss.DIR == MSR_DIR.READ:
                     print(f"  Instruction:   mrs x{iss.Rt}, {name}")
                 else:
@@ -295,6 +816,62 @@ class ProxyUtils(Reloadable):
     def q(self):
         return self.get_simd(SIMD_Q)
 
+class SMPDecoder:
+    '''Runs gzip decompression jobs on the secondary CPUs.
+
+    Jobs are handed out round-robin with smp_call, through a trampoline that
+    records tinf_gzip_uncompress' result. A CPU that is still running a job
+    must not be handed another one (the new job would be lost, and the boot
+    CPU would spin forever), so the previous job on a CPU is waited for,
+    checked and its buffers released before the next one is submitted.
+    finish() waits for the remaining jobs.'''
+    JOB = struct.Struct("<QQQQQqII")
+
+    def __init__(self, utils, cpus=None):
+        self.u = utils
+        self.func = utils.m1n1_symbol("tinf_gzip_uncompress")
+        self.cpus = cpus if cpus is not None else utils.secondary_cpus()
+        if not self.cpus:
+            raise Exception("no secondary CPUs")
+        utils.proxy.smp_start_secondaries()
+        self.trampoline = utils.smp_trampoline()
+        self.busy = {}
+        self.next = 0
+
+    def submit(self, src, srcsize, dest, destsize, release=None):
+        cpu = self.cpus[self.next % len(self.cpus)]
+        self.next += 1
+        if cpu in self.busy:
+            self.u.smp_wait(cpu)
+            self._reap(*self.busy.pop(cpu))
+
+        p = self.u.proxy
+        job = self.u.malloc(self.JOB.size)
+        self.u.iface.writemem(job, self.JOB.pack(self.func, dest, job + 48, src, job + 52,
+                                                 -1, destsize, srcsize))
+        # The secondaries may not be cache coherent with us
+        p.dc_cvac(job, self.JOB.size)
+        p.dc_cvac(src, srcsize)
+        p.dc_civac(dest, destsize)
+        p.smp_call(cpu, self.trampoline, job)
+        self.busy[cpu] = job, dest, destsize, release
+
+    def _reap(self, job, dest, destsize, release):
+        self.u.proxy.dc_civac(job, self.JOB.size)
+        self.u.proxy.dc_civac(dest, destsize)
+        *args, ret, outsize, insize = self.JOB.unpack(self.u.iface.readmem(job, self.JOB.size))
+        self.u.free(job)
+        if release is not None:
+            release()
+        if ret != 0 or outsize != destsize:
+            raise Exception(f"Decompression to 0x{dest:x} failed ({ret}, 0x{outsize:x} != 0x{destsize:x} bytes)")
+
+    def finish(self):
+        for cpu, job in list(self.busy.items()):
+            self.u.smp_wait(cpu)
+            del self.busy[cpu]
+            self._reap(*job)
+
 class LazyADT:
     def __init__(self, utils):
         self.__dict__["_utils"] = utils
@@ -336,11 +913,13 @@ class RegMonitor(Reloadable):
             self.scratch = None
 
     def readmem(self, start, size):
-        if self.scratch:
-            assert size < self.bufsize
-            self.proxy.memcpy32(self.scratch, start, size)
-            start = self.scratch
-        return self.proxy.iface.readmem(start, size)
+        # Polling yields to interactive users; the scratch buffer is shared
+        with self.iface.priority(PRIO.BACKGROUND), self.iface.exclusive():
+            if self.scratch:
+                assert size < self.bufsize
+                self.proxy.memcpy32(self.scratch, start, size)
+                start = self.scratch
+            return self.proxy.iface.readmem(start, size)
 
     def add(self, start, size, name=None, offset=None):
         if offset is None:
@@ -404,6 +983,81 @@ class RegMonitor(Reloadable):
                     print()
         self.last = cur
 
+class MemWatch(Reloadable):
+    '''Tracks changes to a (large) region of RAM.
+
+    Each poll() hashes the region on the target (region_hashes), fetches only
+    the blocks whose hash changed since the previous poll, and returns the
+    byte-level differences as a list of (addr, old, new). When nothing
+    changed, a poll only costs the transfer of one CRC32 per block. Not meant
+    for MMIO, as the target reads the whole region with 64-bit loads.'''
+
+    # Changed byte runs separated by fewer equal bytes than this are merged
+    MERGE_GAP = 4
+
+    def __init__(self, utils, start, size, block=0x1000, name=None):
+        self.utils = utils
+        self.iface = utils.iface
+        self.start = start
+        self.size = size
+        self.block = block
+        self.name = name
+        self.hashes = None
+        self.data = None
+        self._diff_re = re.compile(b"[^\\x00]+(?:\\x00{1,%d}[^\\x00]+)*" % (self.MERGE_GAP - 1))
+
+    def snapshot(self):
+        '''read the whole region and use it as the reference for the next poll'''
+        self.data = bytearray(self.iface.readmem(self.start, self.size))
+        self.hashes = [zlib.crc32(self.data[off:off + self.block])
+                       for off in range(0, self.size, self.block)]
+
+    def changed_blocks(self):
+        '''return [(offset, size)] of the runs of blocks that changed since the last poll'''
+        hashes = self.utils.region_hashes(self.start, self.size, self.block)
+        runs = []
+        for i, (old, new) in enumerate(zip(self.hashes, hashes)):
+            if old == new:
+                continue
+            off = i * self.block
+            size = min(self.block, self.size - off)
+            if runs and runs[-1][0] + runs[-1][1] == off:
+                runs[-1] = runs[-1][0], runs[-1][1] + size
+            else:
+                runs.append((off, size))
+        self.hashes = hashes
+        return runs
+
+    def _diff(self, off, old, new):
+        x = (int.from_bytes(old, "little") ^ int.from_bytes(new, "little")).to_bytes(len(old), "little")
+        return [(self.start + off + m.start(), bytes(old[m.start():m.end()]), bytes(new[m.start():m.end()]))
+                for m in self._diff_re.finditer(x)]
+
+    def poll(self, show=False):
+        '''return [(addr, old bytes, new bytes)] for everything that changed since
+        the last poll (or snapshot); the first poll just takes a snapshot'''
+        if self.data is None:
+            self.snapshot()
+            return []
+
+        diffs = []
+        with self.iface.priority(PRIO.BACKGROUND):
+            runs = self.changed_blocks()
+            reads = [(self.start + off, size) for off, size in runs]
+            for (off, size), (addr, data) in zip(runs, self.iface.readmem_many(reads)):
+                diffs.extend(self._diff(off, self.data[off:off + size], data))
+                self.data[off:off + size] = data
+
+        if show:
+            self.show(diffs)
+        return diffs
+
+    def show(self, diffs):
+        if diffs and self.name:
+            print(f"# {self.name} ({self.start:#x}..{self.start + self.size - 1:#x})")
+        for addr, old, new in diffs:
+            print(f"{addr:016x} {old.hex()} -> {new.hex()}")
+
 class GuardedHeap:
     def __init__(self, malloc, memalign=None, free=None):
         if isinstance(malloc, Heap):
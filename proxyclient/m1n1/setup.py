@@ -1,27 +1,36 @@
 # SPDX-License-Identifier: MIT
-import os, struct, sys, time
+import importlib, os, struct, sys, time
 
-from .hv import HV
 from .proxy import *
 from .proxyutils import *
 from .sysreg import *
 from .tgtypes import *
 from .utils import *
 
-# Create serial connection
-iface = UartInterface()
-# Construct m1n1 proxy layer over serial connection
-p = M1N1Proxy(iface, debug=False)
-# Customise parameters of proxy and serial port
-# based on information sent over the connection
-bootstrap_port(iface, p)
+if "M1N1DAEMON" in os.environ:
+    # Go through a proxy daemon (m1n1.daemon), which owns the link and
+    # already has the session state
+    from .daemon import DaemonInterface
+    iface = DaemonInterface()
+    p = M1N1Proxy(iface, debug=False)
+    u = ProxyUtils(p, session=iface.session)
+else:
+    # Create serial connection
+    iface = UartInterface()
+    # Construct m1n1 proxy layer over serial connection
+    p = M1N1Proxy(iface, debug=False)
+    # Customise parameters of proxy and serial port
+    # based on information sent over the connection
+    bootstrap_port(iface, p)
 
-# Initialise the Proxy interface from values fetched from
-# the remote end
-u = ProxyUtils(p)
+    # Initialise the Proxy interface from values fetched from
+    # the remote end
+    u = ProxyUtils(p)
 # Build a Register Monitoring object on Proxy Interface
-mon = RegMonitor(u)
-hv = HV(iface, p, u)
+mon = Lazy(lambda: RegMonitor(u))
+# The hypervisor (and everything it imports) is only set up on first use
+HV = Lazy(lambda: importlib.import_module(".hv", __package__).HV)
+hv = Lazy(lambda: HV(iface, p, u))
 
 fb = u.ba.video.base
 
@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: MIT
+import array, bisect, functools, mmap, os, struct, sys
+
+from .utils import cache_path, cache_store
+
+__all__ = ["SymbolTable"]
+
+class SymbolTable:
+    '''A sorted, compact symbol table.
+
+    Addresses are kept in an array of u64, sorted (ties by name), with the
+    names packed into one NUL-separated blob indexed by an array of u32
+    offsets. The same layout is used on disk, so a saved table can be mmapped
+    and used directly without parsing.'''
+
+    MAGIC = b"M1SYMTB1"
+    HEADER = struct.Struct("<8sII")
+    LOOKUP_CACHE_SIZE = 4096
+
+    def __init__(self, addrs=None, offsets=None, names=b""):
+        self.addrs = addrs if addrs is not None else array.array("Q")
+        self.offsets = offsets if offsets is not None else array.array("I", [0])
+        self.names = names
+        # The table never changes, so single lookups (the same few PCs over
+        # and over in traces) can be memoized per table.
+        self.lookup = functools.lru_cache(maxsize=self.LOOKUP_CACHE_SIZE)(self._lookup)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        '''build a table from an iterable of (addr, name)'''
+        pairs = sorted(pairs)
+        addrs = array.array("Q", (addr for addr, name in pairs))
+        names = [name.encode("ascii", "replace") + b"\0" for addr, name in pairs]
+        offsets = array.array("I", [0])
+        pos = 0
+        for name in names:
+            pos += len(name)
+            offsets.append(pos)
+        return cls(addrs, offsets, b"".join(names))
+
+    @classmethod
+    def from_dict(cls, symbols):
+        '''build a table from a name -> addr dict, such as MachO.symbols'''
+        return cls.from_pairs((v, k) for k, v in symbols.items())
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def name(self, idx):
+        return str(self.names[self.offsets[idx]:self.offsets[idx + 1] - 1], "ascii")
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        return self.addrs[idx], self.name(idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index(self, addr):
+        '''return the index of the last symbol at or below addr, or -1'''
+        return bisect.bisect_right(self.addrs, addr) - 1
+
+    def _lookup(self, addr):
+        '''return (symbol address, name) for addr, or (None, None)'''
+        idx = self.index(addr)
+        if idx < 0:
+            return None, None
+        return self[idx]
+
+    def lookup_many(self, addrs):
+        '''look up a batch of addresses, returning a list of (symbol address, name)
+
+        The batch is walked in sorted order, so each search only covers the
+        part of the table past the previous hit.'''
+        result = [(None, None)] * len(addrs)
+        found = {}
+        lo = 0
+        for i in sorted(range(len(addrs)), key=addrs.__getitem__):
+            idx = bisect.bisect_right(self.addrs, addrs[i], lo) - 1
+            if idx < 0:
+                continue
+            lo = idx
+            if idx not in found:
+                found[idx] = self[idx]
+            result[i] = found[idx]
+        return result
+
+    def tobytes(self):
+        assert sys.byteorder == "little"
+        header = self.HEADER.pack(self.MAGIC, len(self.addrs), len(self.names))
+        return b"".join((header, self.addrs.tobytes(), self.offsets.tobytes(),
+                         bytes(-len(self.offsets) * 4 & 7), bytes(self.names)))
+
+    def save(self, path):
+        cache_store(path, self.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        '''mmap a table previously written by save()'''
+        with open(path, "rb") as fd:
+            data = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, count, namesize = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise Exception(f"{path}: not a symbol table")
+        off = cls.HEADER.size
+        addrs = data[off:off + 8 * count].cast("Q")
+        off += 8 * count
+        offsets = data[off:off + 4 * (count + 1)].cast("I")
+        off += 4 * (count + 1)
+        off += -off & 7
+        names = data[off:off + namesize]
+        if len(names) != namesize:
+            raise Exception(f"{path}: truncated symbol table")
+        return cls(addrs, offsets, names)
+
+    @classmethod
+    def cached(cls, key, build):
+        '''load the table cached under key, or build() it and cache it'''
+        path = cache_path("symbols", key + ".sym")
+        if path is not None and os.path.exists(path):
+            try:
+                return cls.load(path)
+            except Exception:
+                pass
+
+        table = build()
+        if not isinstance(table, cls):
+            table = cls.from_dict(table)
+        if path is not None:
+            table.save(path)
+        return table
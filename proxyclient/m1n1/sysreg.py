@@ -1,23 +1,61 @@
 # SPDX-License-Identifier: MIT
-import json, os, re
+import json, marshal, os, re
 from enum import Enum, IntEnum
-from .utils import Register, Register64, Register32
+from .utils import Register, Register64, Register32, cache_path, cache_store
 
-__all__ = ["sysreg_fwd", "sysreg_rev"]
+_SOURCES = [os.path.join(os.path.dirname(__file__), "..", "..", "tools", fname)
+            for fname in ["arm_regs.json", "apple_regs.json"]]
 
 def _load_registers():
-    for fname in ["arm_regs.json", "apple_regs.json"]:
-        data = json.load(open(os.path.join(os.path.dirname(__file__), "..", "..", "tools", fname)))
-        for reg in data:
-            yield reg["name"], tuple(reg["enc"])
+    # Parsing the JSON register lists is most of the cost of importing this
+    # module, so the (name, enc) list is cached as marshal data, keyed on the
+    # mtime and size of the sources.
+    key = tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, _SOURCES))
+    path = cache_path("sysreg.marshal")
+    if path is not None and os.path.exists(path):
+        try:
+            with open(path, "rb") as fd:
+                cached_key, regs = marshal.load(fd)
+            if cached_key == key:
+                return regs
+        except Exception:
+            pass
+
+    regs = []
+    for fname in _SOURCES:
+        with open(fname) as fd:
+            regs.extend((reg["name"], tuple(reg["enc"])) for reg in json.load(fd))
+    if path is not None:
+        cache_store(path, marshal.dumps((key, regs)))
+    return regs
+
+def _load():
+    # The register tables and the per-register globals are only set up on
+    # first use, through __getattr__ (or a call to one of the functions below)
+    g = globals()
+    if "sysreg_fwd" in g:
+        return
+    fwd = dict(_load_registers())
+    g.update(fwd)
+    g["sysreg_rev"] = {v: k for k, v in fwd.items()}
+    g["sysreg_fwd"] = fwd
+    g["__all__"] = ["sysreg_fwd", "sysreg_rev"] + list(fwd) + _all
 
-sysreg_fwd = dict(_load_registers())
-sysreg_rev = {v: k for k, v in sysreg_fwd.items()}
+def __getattr__(name):
+    if name.startswith("__") and name != "__all__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    _load()
+    try:
+        return globals()[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
 
-globals().update(sysreg_fwd)
-__all__.extend(sysreg_fwd.keys())
+def __dir__():
+    _load()
+    return list(globals())
 
 def sysreg_name(enc):
+    _load()
     if enc in sysreg_rev:
         return sysreg_rev[enc]
     return f"s{enc[0]}_{enc[1]}_c{enc[2]}_c{enc[3]}_{enc[4]}"
@@ -31,6 +69,7 @@ def sysreg_parse(s):
             enc = tuple(map(int, m.groups()))
             break
     else:
+        _load()
         try:
             enc = sysreg_fwd[s]
         except KeyError:
@@ -289,5 +328,5 @@ class DBGBCR(Register32):
     PMC = 2,1
     E = 0
 
-__all__.extend(k for k, v in globals().items()
-               if (callable(v) or isinstance(v, type)) and v.__module__ == __name__)
+_all = [k for k, v in globals().items()
+        if not k.startswith("_") and (callable(v) or isinstance(v, type)) and v.__module__ == __name__]
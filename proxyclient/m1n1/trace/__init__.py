@@ -143,7 +143,9 @@ class PrintTracer(Tracer):
         dev, zone = self.device_addr_tbl.lookup(evt.addr)
         t = "W" if evt.flags.WRITE else "R"
         m = "+" if evt.flags.MULTI else " "
-        print(f"[0x{evt.pc:016x}] MMIO: {t}.{1<<evt.flags.WIDTH:<2}{m} " +
+        # Events come in one at a time; the symbol lookups are cached
+        pc = self.hv.addr(evt.pc) if self.hv.sym(evt.pc)[1] else f"0x{evt.pc:016x}"
+        print(f"[{pc}] MMIO: {t}.{1<<evt.flags.WIDTH:<2}{m} " +
               f"0x{evt.addr:x} ({dev}, offset {evt.addr - zone.start:#04x}) = 0x{evt.data:x}")
 
 class ADTDevTracer(Tracer):
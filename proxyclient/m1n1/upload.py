@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: MIT
+import gzip, lzma, math, re, zlib
+from collections import Counter
+
+__all__ = ["UploadPlanner", "compress", "entropy", "find_fill_runs"]
+
+CODECS = ("raw", "gz", "xz")
+
+def compress(codec, data):
+    '''compress data with one of CODECS, in a format the target can decode'''
+    if codec == "gz":
+        return gzip.compress(data)
+    elif codec == "xz":
+        # xz-embedded on the target only supports CRC32 integrity checks
+        return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32)
+    elif codec == "raw":
+        return data
+    else:
+        raise ValueError(f"Unknown codec {codec!r}")
+
+def entropy(data):
+    '''Shannon entropy of data, in bits per byte'''
+    if not len(data):
+        return 0.0
+    n = len(data)
+    return -sum(c / n * math.log2(c / n) for c in Counter(bytes(data)).values())
+
+_ZEROS = re.compile(b"\\x00*")
+
+def find_fill_runs(data, base=0, min_run=0x4000):
+    '''find runs of a repeated 64-bit pattern (including zeros) in data.
+
+    Returns a list of (offset, size, pattern, width): width is 1 if the run
+    is a single repeated byte (so it can be filled with memset8 at any
+    alignment), otherwise 8, in which case offset and size are aligned so
+    that base + offset is 8-byte aligned and the run can be filled with
+    memset64. Only runs of at least min_run bytes are returned; runs do not
+    overlap.'''
+    data = memoryview(data).cast("B")
+    if len(data) < max(min_run, 16):
+        return []
+
+    # Byte i of diff is zero iff data[i] == data[i + 8], so a run of zeros in
+    # diff of length n means data[s:s + n + 8] repeats with a period of 8.
+    a = int.from_bytes(data[:-8], "little")
+    b = int.from_bytes(data[8:], "little")
+    diff = (a ^ b).to_bytes(len(data) - 8, "little")
+    del a, b
+
+    runs = []
+    need = max(1, min_run - 8)
+    seed = bytes(min(need, 64))
+    pos = 0
+    last = 0
+    while (start := diff.find(seed, pos)) != -1:
+        pos = _ZEROS.match(diff, start).end()
+        if pos - start < need:
+            continue
+        end = pos + 8
+        # A run covers 8 bytes past its match in diff, which the next one
+        # may start in
+        start = max(start, last)
+        word = bytes(data[start:start + 8])
+        if word == word[:1] * 8:
+            if end - start >= min_run:
+                runs.append((start, end - start, word[0], 1))
+                last = end
+            continue
+        astart = start + (-(base + start) & 7)
+        aend = end - ((base + end) & 7)
+        if aend - astart >= min_run:
+            pattern = int.from_bytes(data[astart:astart + 8], "little")
+            runs.append((astart, aend - astart, pattern, 8))
+            last = aend
+    return runs
+
+class UploadPlanner:
+    '''Picks the fastest way (raw, gzip or xz) to get a chunk of data to the target.
+
+    For each codec, the time to upload a chunk is estimated as the larger of
+    the host compression time (spread over the compression workers, since
+    that runs in parallel with the link) and the transfer time of the
+    compressed data plus its decompression time on the target. Compression
+    ratios are estimated from a sample of the chunk; high entropy samples
+    (already compressed data) are assumed not to compress at all. The link
+    rate is measured from the actual uploads.'''
+
+    # Rough throughputs, in bytes of uncompressed data per second
+    HOST_RATE = {"gz": 15e6, "xz": 2.5e6}       # per host core
+    TARGET_RATE = {"gz": 80e6, "xz": 25e6}      # on the target CPU
+    # Typical xz output size relative to gzip
+    XZ_RATIO = 0.85
+    # Sample size used to estimate compressibility
+    SAMPLE_SIZE = 64 * 1024
+    # Above this entropy (bits/byte), data is considered incompressible
+    MAX_ENTROPY = 7.5
+
+    def __init__(self, link_rate=None, workers=1):
+        self.link_rate = link_rate
+        self.workers = workers
+
+    def record(self, size, seconds):
+        '''update the link rate estimate from an upload of size bytes'''
+        if seconds <= 0:
+            return
+        rate = size / seconds
+        if self.link_rate is None:
+            self.link_rate = rate
+        else:
+            self.link_rate = 0.7 * self.link_rate + 0.3 * rate
+
+    def _sample(self, data):
+        if len(data) <= self.SAMPLE_SIZE:
+            return data
+        # A few slices spread over the chunk
+        part = self.SAMPLE_SIZE // 4
+        step = (len(data) - part) // 3
+        return b"".join(data[i * step:i * step + part] for i in range(4))
+
+    def ratio(self, data):
+        '''estimated gzip compressed/uncompressed size ratio of data'''
+        sample = self._sample(data)
+        if not len(sample) or entropy(sample) > self.MAX_ENTROPY:
+            return 1.0
+        return min(1.0, len(zlib.compress(sample, 6)) / len(sample))
+
+    def estimate(self, data, ratio=None):
+        '''return {codec: estimated seconds} for uploading data'''
+        size = len(data)
+        link = self.link_rate or 1e6
+        if ratio is None:
+            ratio = self.ratio(data)
+
+        times = {"raw": size / link}
+        xz_ratio = ratio * self.XZ_RATIO if ratio < 1.0 else 1.0
+        for codec, cratio in (("gz", ratio), ("xz", xz_ratio)):
+            host = size / self.HOST_RATE[codec] / self.workers
+            target = cratio * size / link + size / self.TARGET_RATE[codec]
+            times[codec] = max(host, target)
+        return times
+
+    def choose(self, data):
+        times = self.estimate(data)
+        return min(times, key=times.get)
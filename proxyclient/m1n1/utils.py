@@ -67,6 +67,51 @@ def unhex(s):
     s = re.sub(r"/\*.*?\*/", "", s)
     return bytes.fromhex(s.replace(" ", "").replace("\n", ""))
 
+def cache_path(*parts):
+    '''Return a path inside the host-side m1n1 cache directory.
+
+    The cache lives in $M1N1CACHE, or $XDG_CACHE_HOME/m1n1 (~/.cache/m1n1) by
+    default. Returns None if caching is disabled by setting M1N1CACHE to an
+    empty string.'''
+    base = os.environ.get("M1N1CACHE", None)
+    if base is None:
+        base = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "m1n1")
+    elif not base:
+        return None
+    path = os.path.join(base, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def cache_store(path, data):
+    '''Atomically write data to a cache file.'''
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fd:
+        fd.write(data)
+    os.replace(tmp, path)
+
+def diff_ranges(old, new, block=64, gap=256):
+    '''Return the [start, end) ranges of new that differ from old.
+
+    Comparison is done in block sized units; ranges separated by less than
+    gap bytes are merged. Anything beyond the end of old counts as changed.'''
+    old, new = memoryview(old), memoryview(new)
+    ranges = []
+    common = min(len(old), len(new))
+    for off in range(0, common, block):
+        end = min(off + block, common)
+        if old[off:end] == new[off:end]:
+            continue
+        if ranges and off - ranges[-1][1] < gap:
+            ranges[-1][1] = end
+        else:
+            ranges.append([off, end])
+    if len(new) > common:
+        if ranges and common - ranges[-1][1] < gap:
+            ranges[-1][1] = len(new)
+        else:
+            ranges.append([common, len(new)])
+    return [tuple(r) for r in ranges]
+
 class ReloadableMeta(type):
     def __new__(cls, name, bases, dct):
         m = super().__new__(cls, name, bases, dct)
@@ -109,6 +154,32 @@ class Constant:
         assert v == self.value
         return v
 
+class Lazy:
+    '''Stand-in for an object that is only created on first use.
+
+    factory() is called (once) the first time an attribute is accessed or
+    the object is called, and everything is forwarded to its result.'''
+    def __init__(self, factory):
+        self.__dict__["_factory"] = factory
+
+    @functools.cached_property
+    def _obj(self):
+        return self._factory()
+    def __getattr__(self, attr):
+        return getattr(self._obj, attr)
+    def __setattr__(self, attr, value):
+        return setattr(self._obj, attr, value)
+    def __delattr__(self, attr):
+        return delattr(self._obj, attr)
+    def __call__(self, *args, **kwargs):
+        return self._obj(*args, **kwargs)
+    def __dir__(self):
+        return dir(self._obj)
+    def __repr__(self):
+        if "_obj" in self.__dict__:
+            return repr(self._obj)
+        return f"<lazy {self._factory!r}>"
+
 class RegisterMeta(ReloadableMeta):
     def __new__(cls, name, bases, dct):
         m = super().__new__(cls, name, bases, dct)
@@ -8,6 +8,8 @@ import argparse, pathlib, time
 parser = argparse.ArgumentParser(description='Mach-O loader for m1n1')
 parser.add_argument('-x', '--xnu', action="store_true", help="Load XNU")
 parser.add_argument('-c', '--call', action="store_true", help="Use call mode")
+parser.add_argument('-d', '--delta', action="store_true",
+                    help="Only upload the parts of the image that changed since the last chainload")
 parser.add_argument('payload', type=pathlib.Path)
 parser.add_argument('boot_args', default=[], nargs="*")
 args = parser.parse_args()
@@ -17,9 +19,12 @@ from m1n1.tgtypes import BootArgs
 from m1n1.macho import MachO
 from m1n1 import asm
 
-macho = MachO(args.payload.read_bytes())
+macho = MachO(args.payload.open("rb"))
 
-image = macho.prepare_image()
+if args.delta:
+    image = macho.prepare_image()
+else:
+    image = macho.stream_image()
 
 new_base = u.base
 
@@ -32,7 +37,7 @@ if args.xnu:
 else:
     sepfw_start, sepfw_length = 0, 0
 
-image_size = align(len(image))
+image_size = align(macho.image_size)
 sepfw_off = image_size
 image_size += align(sepfw_length)
 bootargs_off = image_size
@@ -42,9 +47,17 @@ image_size += bootargs_size
 print(f"Total region size: 0x{image_size:x} bytes")
 image_addr = u.malloc(image_size)
 
-print(f"Loading kernel image (0x{len(image):x} bytes)...")
-u.compressed_writemem(image_addr, image, True)
-p.dc_cvau(image_addr, len(image))
+print(f"Loading kernel image (0x{macho.image_size:x} bytes)...")
+if args.delta:
+    try:
+        machine = u.adt.serial_number
+    except (AttributeError, KeyError):
+        machine = "unknown"
+    sent = u.delta_writemem(image_addr, image, f"chainload-{machine}-{image_addr:x}")
+    print(f"Sent 0x{sent:x} changed bytes")
+else:
+    u.write_image(image_addr, image, True)
+p.dc_cvau(image_addr, macho.image_size)
 
 if args.xnu:
     print(f"Copying SEPFW (0x{sepfw_length:x} bytes)...")
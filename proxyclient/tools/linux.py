@@ -10,7 +10,9 @@ parser = argparse.ArgumentParser(description='(Linux) kernel loader for m1n1')
 parser.add_argument('payload', type=pathlib.Path)
 parser.add_argument('dtb', type=pathlib.Path)
 parser.add_argument('initramfs', nargs='?', type=pathlib.Path)
-parser.add_argument('--compression', choices=['auto', 'none', 'gz', 'xz'], default='auto')
+parser.add_argument('--compression', choices=['auto', 'none', 'gz', 'xz', 'upload'], default='auto',
+                    help="payload compression; 'upload' compresses on the host as it is uploaded, "
+                         "picking raw/gz/xz per chunk (the default for uncompressed payloads)")
 parser.add_argument('-b', '--bootargs', type=str, metavar='"boot arguments"')
 parser.add_argument('-t', '--tty', type=str)
 parser.add_argument('-u', '--u-boot', type=pathlib.Path, help="load u-boot before linux")
@@ -25,7 +27,7 @@ if args.compression == 'auto':
     elif suffix == '.xz':
         args.compression = 'xz'
     else:
-        raise ValueError('unknown compression for {}'.format(args.payload))
+        args.compression = 'upload'
 
 if args.tty is not None:
     tty_dev = serial.Serial(args.tty)
@@ -47,7 +49,7 @@ if args.bootargs is not None:
     print('Setting boot args: "{}"'.format(args.bootargs))
     p.kboot_set_bootargs(args.bootargs)
 
-if args.compression != 'none':
+if args.compression not in ('none', 'upload'):
     compressed_size = len(payload)
     compressed_addr = u.malloc(compressed_size)
 
@@ -70,7 +72,7 @@ assert not (kernel_base & 0xffff)
 if initramfs is not None:
     initramfs_base = u.memalign(65536, initramfs_size)
     print("Loading %d initramfs bytes to 0x%x..." % (initramfs_size, initramfs_base))
-    iface.writemem(initramfs_base, initramfs, True)
+    u.compressed_writemem(initramfs_base, initramfs, True)
     p.kboot_set_initrd(initramfs_base, initramfs_size)
 
 
@@ -121,6 +123,10 @@ if args.compression == 'none':
     kernel_size = len(payload)
     print("Loading %d bytes to 0x%x..0x%x..." % (kernel_size, kernel_base, kernel_base + kernel_size))
     iface.writemem(kernel_base, payload, True)
+elif args.compression == 'upload':
+    kernel_size = len(payload)
+    print("Uploading %d bytes to 0x%x..0x%x..." % (kernel_size, kernel_base, kernel_base + kernel_size))
+    u.compressed_writemem(kernel_base, payload, True, smp=True)
 elif args.compression == 'gz':
     print("Uncompressing gz ...")
     kernel_size = p.gzdec(compressed_addr, compressed_size, kernel_base, kernel_size)
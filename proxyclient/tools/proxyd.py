@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+import argparse, os
+
+from m1n1.daemon import ProxyDaemon
+
+parser = argparse.ArgumentParser(description='Share the m1n1 proxy link with local clients',
+                                 epilog="Clients use the daemon when M1N1DAEMON is set to its socket path.")
+parser.add_argument('socket', nargs="?", default=os.environ.get("M1N1DAEMON", None),
+                    help="socket path (default: $M1N1DAEMON)")
+parser.add_argument('-d', '--device', default=None, help="link device (default: $M1N1DEVICE)")
+args = parser.parse_args()
+if args.socket is None:
+    parser.error("no socket path given and M1N1DAEMON is not set")
+
+ProxyDaemon(args.socket, args.device).serve_forever()
@@ -327,6 +327,9 @@ int proxy_process(ProxyRequest *request, ProxyReply *reply)
                       request->args[3], request->args[4], request->args[5]);
             reply->retval = smp_wait(request->args[0]);
             break;
+        case P_SMP_WAIT:
+            reply->retval = smp_wait(request->args[0]);
+            break;
 
         case P_HEAPBLOCK_ALLOC:
             reply->retval = (u64)heapblock_alloc(request->args[0]);